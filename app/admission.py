@@ -0,0 +1,131 @@
+import math
+import sqlite3
+import threading
+from functools import wraps
+
+from flask import has_request_context, request
+from sqlalchemy import event
+
+# ----------------------------
+# ADMISSION CONTROL
+# ----------------------------
+
+# write endpoints go through three checks before touching the database:
+#   1. load shedding when too many requests in this worker are already doing
+#      db work (the connection pool is per process) -> 503
+#   2. a per-user token bucket shared by all workers -> 429
+#   3. a per-route concurrency limit in this worker -> 503
+# every rejection carries a Retry-After header.
+#
+# a request counts as doing db work from its first pooled connection, reads
+# included, or from being admitted as a write, until its teardown. the
+# defaults follow what a worker can actually run at once, its threads (or
+# gevent connections) capped by the size of its connection pool: shedding
+# starts one below that, and one route gets at most half of it.
+
+DB_WORK = "mosaic.db_work"
+
+DEFAULT_LIMITS = {
+    # bucket: (tokens per second, burst)
+    "vote": (2, 20),
+    "create": (0.2, 5),
+    "update": (0.5, 10),
+    "upload": (0.05, 3),
+}
+
+
+class Admission:
+    def __init__(self, store, app=None):
+        self.store = store
+        self.limits = dict(DEFAULT_LIMITS)
+        self.max_in_flight = 3
+        self.concurrency = 2
+        self.in_flight = 0
+        self.shed = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limits.update(app.config.get("ADMISSION_LIMITS", {}))
+        slots = app.config.get("WORKER_SLOTS", 4)
+        self.max_in_flight = app.config.get("ADMISSION_MAX_IN_FLIGHT", max(1, slots - 1))
+        self.concurrency = app.config.get("ADMISSION_CONCURRENCY", max(1, slots // 2))
+
+        @app.teardown_request
+        def _admission_exit(exc=None):
+            if request.environ.pop(DB_WORK, False):
+                with self._lock:
+                    self.in_flight -= 1
+
+    def watch(self, engines):
+        # the app's engines, once database.init_app has made them. other
+        # engines in the process (migrations, bench scripts) aren't counted
+        for engine in engines:
+            if not event.contains(engine, "checkout", self._checkout):
+                event.listen(engine, "checkout", self._checkout)
+
+    def _checkout(self, *args):
+        # any pooled connection taken while serving a request, on any watched
+        # engine
+        if has_request_context() and not request.environ.get(DB_WORK):
+            with self._lock:
+                self.in_flight += 1
+            request.environ[DB_WORK] = True
+
+    def _admit(self):
+        # the check and the count under one lock, or concurrent writes all
+        # pass the check before any of them is counted
+        counted = request.environ.get(DB_WORK, False)
+        with self._lock:
+            if self.in_flight - counted >= self.max_in_flight:
+                return False
+            if not counted:
+                self.in_flight += 1
+        request.environ[DB_WORK] = True
+        return True
+
+    def limit(self, bucket, concurrency=None):
+        # must go below @authorize, it keys the bucket on the jwt user id
+        def decorator(f):
+            sem = threading.BoundedSemaphore(concurrency or self.concurrency)
+
+            @wraps(f)
+            def decorated_function(*args, user=None, **kws):
+                if not self._admit():
+                    self.shed += 1
+                    return reject(503, "Server busy", 1)
+                rate, burst = self.limits[bucket]
+                try:
+                    ok, wait = self.store.take_token(
+                        f"{bucket}:{user['id']}", rate, burst)
+                except sqlite3.Error:
+                    # don't take the site down with the limiter
+                    ok, wait = True, 0
+                if not ok:
+                    self.throttled += 1
+                    return reject(429, "Too many requests", wait)
+                if not sem.acquire(blocking=False):
+                    self.shed += 1
+                    return reject(503, "Server busy", 1)
+                try:
+                    return f(user=user, *args, **kws)
+                finally:
+                    sem.release()
+            return decorated_function
+        return decorator
+
+    def to_dict(self):
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "concurrency": self.concurrency,
+            "shed": self.shed,
+            "throttled": self.throttled,
+            "limits": self.limits,
+        }
+
+
+def reject(status, message, retry_after):
+    return {"error": message}, status, {"Retry-After": str(max(1, math.ceil(retry_after)))}
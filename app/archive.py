@@ -0,0 +1,190 @@
+import json
+import zlib
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, or_, select
+
+import db
+import notify
+import projection
+import schema
+import shards
+from cache import LRU
+from db import database
+
+# ----------------------------
+# ARCHIVE
+# ----------------------------
+
+# posts older than ARCHIVE_AFTER_DAYS with no comment or vote (on the post or
+# one of its comments) in that time are moved out of posts/comments/votes,
+# which every hot query and index pays for. each becomes one archived_posts row holding its PostSchema dump and
+# every CommentSchema dump, vote totals included, as zlib compressed json.
+# the individual votes are dropped. archived_comments keeps one small row
+# per comment so a comment id still finds its document, and user pages and
+# karma work without opening it. archived rows are written once and never
+# changed: archived posts and comments can't be voted on, replied to, edited
+# or deleted. documents can't change, so workers cache them decoded.
+#
+# comment votes keep no time. a comment vote sets the post's last_activity
+# instead, at most once a day per post and worker, so votes on an old
+# thread's comments keep it live too.
+
+# a comment's parent id is kept in its dump under this key, never returned
+PARENT = "parent"
+
+_docs = LRU(1000)
+DOC_TTL = 60 * 60
+
+# post ids whose last_activity this worker set in the last TOUCH_EVERY
+_touched = LRU(10000)
+TOUCH_EVERY = 24 * 60 * 60
+
+
+def touch(post_id):
+    # call after the comment vote is committed
+    if _touched.get(post_id):
+        return
+    now = datetime.now()
+    database.session.query(db.Post).filter(
+        db.Post.id == post_id,
+        or_(db.Post.last_activity.is_(None),
+            db.Post.last_activity < now - timedelta(seconds=TOUCH_EVERY)),
+    ).update({db.Post.last_activity: now}, synchronize_session=False)
+    database.session.commit()
+    _touched.set(post_id, True, TOUCH_EVERY)
+
+
+def candidates(before, limit):
+    # posts created before `before` and left alone since, oldest first
+    return [r[0] for r in database.session.query(db.Post.id).filter(
+        db.Post.time_created < before,
+        ~exists().where(db.Comment.post_id == db.Post.id,
+                        db.Comment.time_created >= before),
+        ~exists().where(db.Vote.post_id == db.Post.id, db.Vote.time >= before),
+        or_(db.Post.last_activity.is_(None), db.Post.last_activity < before),
+    ).order_by(db.Post.id).limit(limit).all()]
+
+
+def archive_post(post_id):
+    post = database.session.query(db.Post).get(post_id)
+    if post is None:
+        return False
+    comments = database.session.query(db.Comment).filter_by(
+        post_id=post_id).order_by(db.Comment.id).all()
+    comment_schema = schema.CommentSchema()
+    doc = {
+        "post": schema.PostSchema().dump(post),
+        "comments": [dict(comment_schema.dump(c), **{PARENT: c.parent_comment})
+                     for c in comments],
+    }
+    database.session.add(db.ArchivedPost(
+        id=post.id, user_id=post.user_id, community_id=post.community_id,
+        time_created=post.time_created,
+        karma=(post.upvotes or 0) - (post.downvotes or 0),
+        data=zlib.compress(json.dumps(doc).encode("utf-8")),
+    ))
+    database.session.add_all(db.ArchivedComment(
+        id=c.id, post_id=post.id, user_id=c.user_id, time_created=c.time_created,
+        karma=(c.upvotes or 0) - (c.downvotes or 0),
+    ) for c in comments)
+    # nothing left to open, and the unread counts shouldn't wait on them
+    notify.forget(db.Notification.post_id == post_id)
+    ids = select(db.Comment.id).where(db.Comment.post_id == post_id)
+    database.session.query(db.CommentVote).filter(
+        db.CommentVote.comment_id.in_(ids)).delete(synchronize_session=False)
+    database.session.query(db.Vote).filter(
+        db.Vote.post_id == post_id).delete(synchronize_session=False)
+    database.session.query(db.Comment).filter(
+        db.Comment.post_id == post_id).delete(synchronize_session=False)
+    database.session.query(db.Post).filter(
+        db.Post.id == post_id).delete(synchronize_session=False)
+    database.session.commit()
+    return True
+
+
+def run(days, limit):
+    # archive up to `limit` posts on every shard, returns their ids. each
+    # post is its own transaction
+    before = datetime.now() - timedelta(days=days)
+    done = []
+    for _ in shards.each():
+        for post_id in candidates(before, limit):
+            if archive_post(post_id):
+                done.append(post_id)
+    return done
+
+# reads, each on the shard of the id it is given
+
+
+def document(post_id):
+    doc = _docs.get(post_id)
+    if doc is not None:
+        return doc
+    with shards.using(shards.of_id(post_id)):
+        data = database.session.query(db.ArchivedPost.data).filter(
+            db.ArchivedPost.id == post_id).scalar()
+    if data is None:
+        return None
+    doc = json.loads(zlib.decompress(data))
+    doc["index"] = {c["id"]: c for c in doc["comments"]}
+    _docs.set(post_id, doc, DOC_TTL)
+    return doc
+
+
+def _comment(dumped):
+    return {k: v for k, v in dumped.items() if k != PARENT}
+
+
+def post(post_id, fields=None):
+    doc = document(post_id)
+    if doc is None:
+        return None
+    return doc["post"] if fields is None else projection.pick(doc["post"], fields)
+
+
+def post_of(comment_id):
+    with shards.using(shards.of_id(comment_id)):
+        return database.session.query(db.ArchivedComment.post_id).filter(
+            db.ArchivedComment.id == comment_id).scalar()
+
+
+def has_post(post_id):
+    if _docs.get(post_id) is not None:
+        return True
+    with shards.using(shards.of_id(post_id)):
+        return database.session.query(db.ArchivedPost.id).filter(
+            db.ArchivedPost.id == post_id).first() is not None
+
+
+def has_comment(comment_id):
+    return post_of(comment_id) is not None
+
+
+def comment(comment_id):
+    post_id = post_of(comment_id)
+    if post_id is None:
+        return None
+    c = document(post_id)["index"].get(comment_id)
+    return _comment(c) if c is not None else None
+
+
+def top_level(post_id):
+    # newest first like the live comment list, None if not archived
+    doc = document(post_id)
+    if doc is None:
+        return None
+    return [_comment(c) for c in reversed(doc["comments"]) if c[PARENT] is None]
+
+
+def replies(comment_id):
+    # oldest first like the live replies, None if not archived
+    post_id = post_of(comment_id)
+    if post_id is None:
+        return None
+    return [_comment(c) for c in document(post_id)["comments"]
+            if c[PARENT] == comment_id]
+
+
+def to_dict():
+    return {"documents_cached": len(_docs)}
@@ -0,0 +1,277 @@
+import itertools
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# ----------------------------
+# CACHE
+# ----------------------------
+
+# two levels: a small LRU in every worker in front of the kv table of the
+# shared store. values must be json serializable (schema dumps, not orm
+# objects). writes call invalidate(), which drops the key from both levels
+# and broadcasts it to the other workers over udp on localhost.
+#
+# a loader can read a row just before a write commits and invalidates it,
+# and finish after. its value is only cached if the key wasn't invalidated
+# meanwhile: in this worker (Generations, which the bus bumps too) and in the
+# shared store (its per key generation), otherwise it would put the old row
+# back in both levels.
+
+# a message too big for one datagram (a long comment in a live event) goes
+# through the kv table, the datagram only carries its key
+MAX_DATAGRAM = 60000
+SPILLED = "\0spilled:"
+
+
+class LRU:
+    def __init__(self, size):
+        self.size = size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        # live entries, most recently used first
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v[0]) for k, v in reversed(self._data.items()) if v[1] > now]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Generations:
+    # when each of the last `size` invalidated keys was invalidated, on one
+    # counter. a loader takes start() before reading and asks changed()
+    # before caching. keys that fell out count as invalidated when the
+    # oldest kept one was, which only ever skips a set
+    def __init__(self, size):
+        self.size = size
+        self._marks = OrderedDict()
+        self._floor = 0
+        self._seq = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        return next(self._seq)
+
+    def bump(self, key):
+        with self._lock:
+            self._marks[key] = next(self._seq)
+            self._marks.move_to_end(key)
+            while len(self._marks) > self.size:
+                _, seq = self._marks.popitem(last=False)
+                self._floor = max(self._floor, seq)
+
+    def changed(self, key, start):
+        with self._lock:
+            return self._marks.get(key, self._floor) > start
+
+
+class InvalidationBus:
+    def __init__(self, store):
+        self.store = store
+        self.handlers = []
+        self.sent = 0
+        self.received = 0
+        self._sock = None
+        self._pid = None
+        self.port = None
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def _ensure(self):
+        # the socket and listener are per process, (re)create them after fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind(("127.0.0.1", 0))
+            self._sock.settimeout(5)
+            self.port = self._sock.getsockname()[1]
+            self.store.register_peer(self.port)
+            self._pid = os.getpid()
+            threading.Thread(target=self._listen, args=(self._sock,),
+                             name="cache-bus", daemon=True).start()
+
+    def start(self):
+        self._ensure()
+
+    def publish(self, keys):
+        self._ensure()
+        msg = "\n".join(keys).encode()
+        try:
+            if len(msg) > MAX_DATAGRAM:
+                ref = f"bus:{os.getpid()}:{next(self._seq)}"
+                self.store.set(ref, msg.decode(), 60)
+                msg = (SPILLED + ref).encode()
+            peers = self.store.peers()
+        except sqlite3.Error:
+            return
+        for port in peers:
+            if port == self.port:
+                continue
+            try:
+                self._sock.sendto(msg, ("127.0.0.1", port))
+                self.sent += 1
+            except OSError:
+                pass
+
+    def _listen(self, sock):
+        last_beat = time.monotonic()
+        while True:
+            try:
+                msg, _ = sock.recvfrom(65535)
+                self.received += 1
+                msg = msg.decode()
+                if msg.startswith(SPILLED):
+                    msg = self._spilled(msg[len(SPILLED):])
+                keys = msg.split("\n")
+                for handler in self.handlers:
+                    handler(keys)
+            except socket.timeout:
+                pass
+            except OSError:
+                return
+            if time.monotonic() - last_beat > 10:
+                try:
+                    self.store.register_peer(self.port)
+                except sqlite3.Error:
+                    pass
+                last_beat = time.monotonic()
+
+    def _spilled(self, ref):
+        # "" when it expired or can't be read, the message is lost
+        try:
+            return self.store.get(ref) or ""
+        except sqlite3.Error:
+            return ""
+
+
+class Cache:
+    def __init__(self, store, app=None, size=4096, ttl=60, local_ttl=30):
+        self.store = store
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.local = LRU(size)
+        self.gens = Generations(size * 4)
+        self.bus = InvalidationBus(store)
+        self.bus.subscribe(self._evict)
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.local.size = app.config.get("CACHE_SIZE", self.local.size)
+        self.ttl = app.config.get("CACHE_TTL", self.ttl)
+        self.local_ttl = min(self.ttl, self.local_ttl)
+
+    def get(self, key, loader):
+        # loader returns the value to cache, or None for "not found" which
+        # is not cached
+        self.bus.start()
+        value = self.local.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        try:
+            raw = self.store.get(key)
+        except sqlite3.Error:
+            raw = None
+        if raw is not None:
+            self.shared_hits += 1
+            value = json.loads(raw)
+            self.local.set(key, value, self.local_ttl)
+            return value
+        self.misses += 1
+        start = self.gens.start()
+        try:
+            gen = self.store.generation(key)
+        except sqlite3.Error:
+            gen = None
+        value = loader()
+        if value is not None and not self.gens.changed(key, start):
+            self._set_loaded(key, value, start, gen)
+        return value
+
+    def _set_loaded(self, key, value, start, gen):
+        if gen is not None:
+            try:
+                if not self.store.set_if(key, json.dumps(value), self.ttl, gen):
+                    return
+            except sqlite3.Error:
+                pass
+        self.local.set(key, value, self.local_ttl)
+        # an invalidate can land between the check and the set
+        if self.gens.changed(key, start):
+            self.local.delete(key)
+
+    def set(self, key, value, ttl=None, local_ttl=None):
+        # ttl shortens both levels, for entries that should expire early.
+        # local_ttl overrides the local level's cap
+        ttl = self.ttl if ttl is None else ttl
+        self.local.set(key, value, min(self.local_ttl, ttl) if local_ttl is None else local_ttl)
+        try:
+            self.store.set(key, json.dumps(value), ttl)
+        except sqlite3.Error:
+            pass
+
+    def invalidate(self, *keys):
+        self._evict(keys)
+        try:
+            self.store.delete(*keys)
+        except sqlite3.Error:
+            pass
+        self.bus.publish(keys)
+
+    def _evict(self, keys):
+        for key in keys:
+            self.gens.bump(key)
+            self.local.delete(key)
+
+    def to_dict(self):
+        return {
+            "local_keys": len(self.local),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "bus_sent": self.bus.sent,
+            "bus_received": self.bus.received,
+        }
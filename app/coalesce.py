@@ -0,0 +1,150 @@
+import threading
+import time
+from functools import wraps
+
+from flask import Response, current_app, request
+
+from stream import negotiated
+
+# ----------------------------
+# REQUEST COALESCING
+# ----------------------------
+
+# concurrent identical reads share one computation. the first request for a
+# key (the leader) runs the view, everyone arriving while it runs waits for
+# its result, and the result is reused for `grace` seconds afterwards. a
+# None result is not reused, the waiters then run fn themselves.
+#
+# writes call forget(path) for the pages they change, which drops the
+# flights for that path and the paths under it in every worker (through the
+# cache invalidation bus), so nobody reads their own write undone from the
+# grace window. a flight already running when the write lands is dropped
+# too: requests arriving after it start a new one.
+
+PREFIX = "flight:"
+
+
+class Flight:
+    __slots__ = ("event", "result", "error", "expires")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.expires = None
+
+
+class SingleFlight:
+    def __init__(self, bus=None, app=None, grace=0.25, max_keys=10000):
+        self.grace = grace
+        self.max_keys = max_keys
+        self.leaders = 0
+        self.followers = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.grace = app.config.get("COALESCE_GRACE", self.grace)
+
+    def do(self, key, fn):
+        with self._lock:
+            now = time.monotonic()
+            fl = self._flights.get(key)
+            if fl is not None and fl.expires is not None and fl.expires <= now:
+                fl = None
+            leader = fl is None
+            if leader:
+                if len(self._flights) >= self.max_keys:
+                    self._sweep(now)
+                fl = Flight()
+                self._flights[key] = fl
+                self.leaders += 1
+            elif fl.event.is_set():
+                self.hits += 1
+            else:
+                self.followers += 1
+        if not leader:
+            fl.event.wait()
+            if fl.error is not None:
+                raise fl.error
+            if fl.result is None:
+                return fn()
+            return fl.result
+        try:
+            fl.result = fn()
+        except Exception as e:
+            fl.error = e
+            raise
+        finally:
+            cache = fl.error is None and fl.result is not None and self.grace > 0
+            fl.expires = time.monotonic() + (self.grace if cache else 0)
+            if not cache:
+                with self._lock:
+                    if self._flights.get(key) is fl:
+                        del self._flights[key]
+            fl.event.set()
+        return fl.result
+
+    def forget(self, path, publish=True):
+        # flights for `path` and everything under it, any query string
+        with self._lock:
+            for key in list(self._flights):
+                p = key[0].split("?", 1)[0]
+                if p == path or p.startswith(path + "/"):
+                    del self._flights[key]
+        if publish and self.bus is not None:
+            self.bus.publish([PREFIX + path])
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith(PREFIX):
+                self.forget(key[len(PREFIX):], publish=False)
+
+    def _sweep(self, now):
+        for k, fl in list(self._flights.items()):
+            if fl.expires is not None and fl.expires <= now:
+                del self._flights[k]
+
+    def coalesce(self, f):
+        # for public GET routes only, the key doesn't include the caller.
+        # streamed responses are never shared: buffering them would undo
+        # the streaming, each caller streams its own
+        @wraps(f)
+        def decorated_function(*args, **kws):
+            streamed = []
+
+            def run():
+                resp = current_app.make_response(f(*args, **kws))
+                if resp.is_streamed:
+                    streamed.append(resp)
+                    return None
+                return snapshot(resp)
+
+            shared = self.do((request.full_path, negotiated()), run)
+            if streamed:
+                return streamed[0]
+            data, status, headers = shared
+            return Response(data, status=status, headers=headers)
+        return decorated_function
+
+    def to_dict(self):
+        total = self.leaders + self.followers + self.hits
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "grace_hits": self.hits,
+            "coalesced_ratio": round((self.followers + self.hits) / total, 4) if total else 0,
+            "keys": len(self._flights),
+            "grace": self.grace,
+        }
+
+
+def snapshot(resp):
+    # waiters each get their own Response, share only the bytes
+    return resp.get_data(), resp.status_code, list(resp.headers.items())
@@ -0,0 +1,342 @@
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func
+
+import db
+from cache import LRU
+from db import database
+
+# ----------------------------
+# COMMENT TREES
+# ----------------------------
+
+# per post comment trees kept in each worker. writes patch the cached tree in
+# place (add, vote counts, delete) instead of dropping it, and send the same
+# patch to the other workers through the cache invalidation bus, so theirs
+# stay cached too. a patch a worker can't apply (the parent of an added
+# comment isn't in its tree) drops that tree instead. patches from two
+# workers can cross on the way, or get lost, so a tree is also reloaded once
+# it is COMMENT_TREE_MAX_AGE seconds old. trees are evicted least recently
+# used first once their estimated size passes the byte budget.
+#
+# a tree over an eighth of the budget isn't cached, callers read the db. a
+# comment count that already puts it over is checked before loading, and a
+# post found too big after loading is remembered for COMMENT_TREE_MAX_AGE
+# seconds, so its requests don't load and throw away the whole tree.
+
+NODE_OVERHEAD = 200
+PREFIX = "treepatch:"
+
+
+class Node:
+    __slots__ = ("id", "parent", "user", "content", "upvotes", "downvotes",
+                 "time_created", "is_deleted", "children")
+
+    def __init__(self, id, parent, user, content, upvotes, downvotes,
+                 time_created, is_deleted):
+        self.id = id
+        self.parent = parent
+        self.user = user
+        self.content = content
+        self.upvotes = upvotes or 0
+        self.downvotes = downvotes or 0
+        # stored the way CommentSchema dumps it
+        self.time_created = time_created.isoformat() if time_created else None
+        self.is_deleted = is_deleted
+        self.children = []
+
+    def fields(self):
+        # the constructor's arguments, for a patch sent to other workers
+        return [self.id, self.parent, self.user, self.content, self.upvotes,
+                self.downvotes, self.time_created, self.is_deleted]
+
+    @classmethod
+    def from_fields(cls, fields):
+        node = cls(*fields[:6], None, fields[7])
+        node.time_created = fields[6]
+        return node
+
+    def nbytes(self):
+        return NODE_OVERHEAD + sys.getsizeof(self.content or "")
+
+    def dump(self, post_id):
+        return {
+            "content": self.content,
+            "downvotes": self.downvotes,
+            "id": self.id,
+            "is_deleted": self.is_deleted,
+            "post": post_id,
+            "time_created": self.time_created,
+            "upvotes": self.upvotes,
+            "user": self.user,
+        }
+
+
+class Tree:
+    __slots__ = ("post_id", "nodes", "roots", "nbytes", "loaded")
+
+    def __init__(self, post_id):
+        self.post_id = post_id
+        self.nodes = {}
+        # ids ascending, both for roots and children
+        self.roots = []
+        self.nbytes = 0
+        self.loaded = time.monotonic()
+
+    def add(self, node):
+        if node.id in self.nodes:
+            return 0
+        if node.parent is not None and node.parent not in self.nodes:
+            # parent is gone, the row will be gone too once the cascade runs
+            return 0
+        self.nodes[node.id] = node
+        siblings = self.roots if node.parent is None else self.nodes[node.parent].children
+        siblings.append(node.id)
+        if len(siblings) > 1 and siblings[-2] > node.id:
+            siblings.sort()
+        size = node.nbytes()
+        self.nbytes += size
+        return size
+
+    def remove(self, comment_id):
+        node = self.nodes.get(comment_id)
+        if node is None:
+            return 0
+        siblings = self.roots if node.parent is None else self.nodes[node.parent].children
+        siblings.remove(comment_id)
+        freed = 0
+        stack = [comment_id]
+        while stack:
+            n = self.nodes.pop(stack.pop())
+            stack.extend(n.children)
+            freed += n.nbytes()
+        self.nbytes -= freed
+        return freed
+
+    def top_level(self):
+        return [self.nodes[i].dump(self.post_id) for i in reversed(self.roots)]
+
+    def replies(self, comment_id):
+        return [self.nodes[i].dump(self.post_id) for i in self.nodes[comment_id].children]
+
+
+def count_comments(post_id):
+    return database.session.query(func.count(db.Comment.id)).filter(
+        db.Comment.post_id == post_id).scalar()
+
+
+def load_tree(post_id):
+    tree = Tree(post_id)
+    rows = database.session.query(
+        db.Comment.id, db.Comment.parent_comment, db.Comment.user_id,
+        db.Comment.content, db.Comment.upvotes, db.Comment.downvotes,
+        db.Comment.time_created, db.Comment.is_deleted,
+    ).filter(db.Comment.post_id == post_id).order_by(db.Comment.id).all()
+    for row in rows:
+        tree.add(Node(*row))
+    return tree
+
+
+class TreeCache:
+    def __init__(self, bus=None, app=None, budget=64 * 1024 * 1024, max_age=300):
+        self.budget = budget
+        self.max_age = max_age
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.too_big = 0
+        # post ids found too big -> True
+        self._too_big = LRU(1024)
+        self._trees = OrderedDict()
+        # comment id -> post id for every cached node
+        self._index = {}
+        # post id -> [loads in progress, written meanwhile]
+        self._loading = {}
+        self._lock = threading.RLock()
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.budget = app.config.get("COMMENT_TREE_BUDGET", self.budget)
+        self.max_age = app.config.get("COMMENT_TREE_MAX_AGE", self.max_age)
+
+    def get(self, post_id):
+        # None when the tree is too big to cache, callers then read the db
+        with self._lock:
+            tree = self._trees.get(post_id)
+            if tree is not None and time.monotonic() - tree.loaded > self.max_age:
+                self._drop(post_id)
+                tree = None
+            if tree is not None:
+                self._trees.move_to_end(post_id)
+                self.hits += 1
+                return tree
+        if self._too_big.get(post_id):
+            self.too_big += 1
+            return None
+        if count_comments(post_id) * NODE_OVERHEAD > self.budget // 8:
+            return self._skip(post_id)
+        with self._lock:
+            self.misses += 1
+            loading = self._loading.setdefault(post_id, [0, False])
+            loading[0] += 1
+        try:
+            tree = load_tree(post_id)
+        finally:
+            with self._lock:
+                loading[0] -= 1
+                written = loading[1]
+                if loading[0] == 0:
+                    del self._loading[post_id]
+        if tree.nbytes > self.budget // 8:
+            return self._skip(post_id)
+        with self._lock:
+            # a write landed while we were reading, our copy may miss it
+            if not written and post_id not in self._trees:
+                self._insert(tree)
+        return tree
+
+    def _skip(self, post_id):
+        self.too_big += 1
+        self._too_big.set(post_id, True, self.max_age)
+        return None
+
+    def post_of(self, comment_id):
+        return self._index.get(comment_id)
+
+    # the dumps run under the lock, writers mutate the trees in place
+
+    def top_level(self, post_id):
+        tree = self.get(post_id)
+        if tree is None:
+            return None
+        with self._lock:
+            return tree.top_level()
+
+    def replies(self, post_id, comment_id):
+        tree = self.get(post_id)
+        if tree is None:
+            return None
+        with self._lock:
+            return tree.replies(comment_id) if comment_id in tree.nodes else []
+
+    def add_comment(self, comment):
+        # built outside the lock, reading expired attributes hits the db
+        node = Node(
+            comment.id, comment.parent_comment, comment.user_id,
+            comment.content, comment.upvotes, comment.downvotes,
+            comment.time_created, comment.is_deleted)
+        self._add(comment.post_id, node)
+        self._publish_patch(comment.post_id, "add", node.fields())
+
+    def set_votes(self, post_id, comment_id, upvotes, downvotes):
+        self._set_votes(post_id, comment_id, upvotes, downvotes)
+        self._publish_patch(post_id, "votes", [comment_id, upvotes, downvotes])
+
+    def remove_comment(self, post_id, comment_id):
+        self._remove(post_id, comment_id)
+        self._publish_patch(post_id, "remove", [comment_id])
+
+    def _add(self, post_id, node):
+        with self._lock:
+            self._touch(post_id)
+            tree = self._trees.get(post_id)
+            if tree is None:
+                return
+            size = tree.add(node)
+            if size:
+                self._index[node.id] = post_id
+                self.nbytes += size
+                self._shrink()
+            elif node.id not in tree.nodes:
+                # missed the parent, this copy can't be trusted any more
+                self._drop(post_id)
+
+    def _set_votes(self, post_id, comment_id, upvotes, downvotes):
+        with self._lock:
+            self._touch(post_id)
+            tree = self._trees.get(post_id)
+            node = tree.nodes.get(comment_id) if tree is not None else None
+            if node is not None:
+                node.upvotes = upvotes
+                node.downvotes = downvotes
+
+    def _remove(self, post_id, comment_id):
+        with self._lock:
+            self._touch(post_id)
+            tree = self._trees.get(post_id)
+            if tree is not None:
+                before = set(tree.nodes)
+                self.nbytes -= tree.remove(comment_id)
+                for cid in before.difference(tree.nodes):
+                    self._index.pop(cid, None)
+
+    def evict(self, post_id, publish=True):
+        with self._lock:
+            self._touch(post_id)
+            self._drop(post_id)
+        if publish:
+            self._publish(post_id)
+
+    def to_dict(self):
+        return {
+            "trees": len(self._trees),
+            "nodes": len(self._index),
+            "bytes": self.nbytes,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "too_big": self.too_big,
+        }
+
+    def _touch(self, post_id):
+        loading = self._loading.get(post_id)
+        if loading is not None:
+            loading[1] = True
+
+    def _insert(self, tree):
+        self._trees[tree.post_id] = tree
+        for cid in tree.nodes:
+            self._index[cid] = tree.post_id
+        self.nbytes += tree.nbytes
+        self._shrink()
+
+    def _drop(self, post_id):
+        tree = self._trees.pop(post_id, None)
+        if tree is None:
+            return
+        for cid in tree.nodes:
+            self._index.pop(cid, None)
+        self.nbytes -= tree.nbytes
+
+    def _shrink(self):
+        while self.nbytes > self.budget and self._trees:
+            self._drop(next(iter(self._trees)))
+
+    def _publish(self, post_id):
+        if self.bus is not None:
+            self.bus.publish([f"tree:{post_id}"])
+
+    def _publish_patch(self, post_id, op, args):
+        if self.bus is not None:
+            self.bus.publish([PREFIX + json.dumps([post_id, op, args])])
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith(PREFIX):
+                post_id, op, args = json.loads(key[len(PREFIX):])
+                if op == "add":
+                    self._add(post_id, Node.from_fields(args))
+                elif op == "votes":
+                    self._set_votes(post_id, *args)
+                elif op == "remove":
+                    self._remove(post_id, *args)
+            elif key.startswith("tree:"):
+                self.evict(int(key[5:]), publish=False)
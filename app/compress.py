@@ -0,0 +1,123 @@
+import gzip
+import zlib
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ----------------------------
+# COMPRESSION
+# ----------------------------
+
+# negotiates Accept-Encoding for json/text responses. buffered responses are
+# compressed when they are at least `threshold` bytes, streamed responses are
+# always compressed chunk by chunk.
+
+COMPRESSIBLE = ("application/json", "application/x-ndjson", "text/")
+
+
+class GzipStream:
+    def __init__(self):
+        self._z = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._z.compress(data) + self._z.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self._z.flush()
+
+
+class BrotliStream:
+    def __init__(self):
+        self._c = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._c.process(data) + self._c.flush()
+
+    def flush(self):
+        return self._c.finish()
+
+
+class ZstdStream:
+    def __init__(self):
+        self._c = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self._c.compress(data) + self._c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def flush(self):
+        return self._c.flush()
+
+
+def _available():
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return encodings
+
+
+def compress_once(encoding, data):
+    if encoding == "gzip":
+        return gzip.compress(data, 6)
+    if encoding == "br":
+        return brotli.compress(data, quality=5)
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+STREAMS = {"gzip": GzipStream, "br": BrotliStream, "zstd": ZstdStream}
+
+
+def compress_chunks(encoding, chunks):
+    stream = STREAMS[encoding]()
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        out = stream.compress(chunk)
+        if out:
+            yield out
+    yield stream.flush()
+
+
+class Compressor:
+    def __init__(self, app=None, threshold=1024):
+        self.threshold = threshold
+        self.encodings = _available()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.threshold = app.config.get("COMPRESS_THRESHOLD", self.threshold)
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        response.vary.add("Accept-Encoding")
+        if response.status_code < 200 or response.status_code in (204, 304) \
+                or "Content-Encoding" in response.headers \
+                or response.direct_passthrough \
+                or response.mimetype == "text/event-stream" \
+                or not (response.mimetype or "").startswith(COMPRESSIBLE):
+            return response
+        encoding = request.accept_encodings.best_match(self.encodings)
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = compress_chunks(encoding, response.response)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < self.threshold:
+                return response
+            response.set_data(compress_once(encoding, data))
+        response.headers["Content-Encoding"] = encoding
+        return response
@@ -1,11 +1,148 @@
-# reset the database every 20 minutes
+# maintenance tasks, run periodically by the job runner in jobs.py
+
+import os
+import time
+
+from sqlalchemy import select, func, update
+
+import db
+import ranking
+import shards
+from db import database
+
+
+# delete those files which are not used
+def delete_old_files(folder):
+    dps = database.session.query(db.User.display_pic).all()
+    cpics = database.session.query(db.Community.display_pic).all()
+    # display pics are stored as /static/<file>, compare by file name
+    used = set(os.path.basename(x[0]) for x in dps + cpics if x[0])
+    for f in os.listdir(folder):
+        if f not in used:
+            os.remove(os.path.join(folder, f))
+
+
+def _count_votes(model, key, flag, value):
+    return select(func.count()).select_from(model).where(
+        key, flag == value).scalar_subquery()
+
+
+def _in_batches(model, values, *criteria, batch=1000, pause=0.05):
+    # the update `batch` ids at a time, each in its own transaction with a
+    # pause after it, like migrations/047_compact_votes.py. row locks are
+    # held for one batch and the vote handlers get in between
+    lo, hi = database.session.query(func.min(model.id), func.max(model.id)).one()
+    database.session.commit()
+    if lo is None:
+        return
+    for first in range(lo, hi + 1, batch):
+        database.session.query(model).filter(
+            model.id >= first, model.id < first + batch, *criteria
+        ).update(values, synchronize_session=False)
+        database.session.commit()
+        time.sleep(pause)
+
+
+# the vote handlers keep upvotes/downvotes as running counters, recount them
+# from the vote tables in case a request died halfway
+def reconcile_post_votes():
+    key = db.Vote.post_id == db.Post.id
+    for _ in shards.each():
+        _in_batches(db.Post, {
+            db.Post.upvotes: _count_votes(db.Vote, key, db.Vote.upvote, True),
+            db.Post.downvotes: _count_votes(db.Vote, key, db.Vote.upvote, False),
+        })
+
+
+def reconcile_comment_votes():
+    key = db.CommentVote.comment_id == db.Comment.id
+    flag = db.CommentVote.is_upvote
+    for _ in shards.each():
+        _in_batches(db.Comment, {
+            db.Comment.upvotes: _count_votes(db.CommentVote, key, flag, True),
+            db.Comment.downvotes: _count_votes(db.CommentVote, key, flag, False),
+        })
+        _reconcile_comment_scores()
+
+
+def _reconcile_comment_scores():
+    # in the database, rows are never loaded here. only rows whose score is
+    # off are written
+    score = ranking.wilson_sql(db.Comment.upvotes, db.Comment.downvotes)
+    _in_batches(db.Comment, {db.Comment.score: score},
+                func.abs(db.Comment.score - score) > 1e-9)
+
+
+def reconcile_sub_counts():
+    subs = select(func.count()).select_from(db.SubscribedCommunity).where(
+        db.SubscribedCommunity.community_id == db.Community.id).scalar_subquery()
+    database.session.query(db.Community).update(
+        {db.Community.sub_count: subs}, synchronize_session=False)
+    database.session.commit()
+
+
+def _unread():
+    return select(func.count()).select_from(db.Notification).where(
+        db.Notification.user_id == db.User.id,
+        db.Notification.is_read.is_(False)).scalar_subquery()
+
+
+def reconcile_user_stats():
+    if shards.count() > 1:
+        return _reconcile_user_stats_sharded()
+
+    def total(model, expr):
+        return select(func.coalesce(expr, 0)).select_from(model).where(
+            model.user_id == db.User.id).scalar_subquery()
+    # archived posts and comments keep counting, with their frozen totals
+    database.session.query(db.User).update({
+        db.User.post_count: total(db.Post, func.count()) +
+        total(db.ArchivedPost, func.count()),
+        db.User.post_karma: total(db.Post, func.sum(db.Post.upvotes - db.Post.downvotes)) +
+        total(db.ArchivedPost, func.sum(db.ArchivedPost.karma)),
+        db.User.comment_count: total(db.Comment, func.count()) +
+        total(db.ArchivedComment, func.count()),
+        db.User.comment_karma: total(db.Comment, func.sum(db.Comment.upvotes - db.Comment.downvotes)) +
+        total(db.ArchivedComment, func.sum(db.ArchivedComment.karma)),
+        db.User.unread_notifs: _unread(),
+    }, synchronize_session=False)
+    database.session.commit()
+
+
+def _reconcile_user_stats_sharded():
+    # posts and comments aren't in the users database, add the per shard
+    # totals up here and write them back by primary key
+    stats = {}
+    for _ in shards.each():
+        for model, kind, expr in (
+                (db.Post, "post", db.Post.upvotes - db.Post.downvotes),
+                (db.Comment, "comment", db.Comment.upvotes - db.Comment.downvotes),
+                (db.ArchivedPost, "post", db.ArchivedPost.karma),
+                (db.ArchivedComment, "comment", db.ArchivedComment.karma)):
+            rows = database.session.query(
+                model.user_id, func.count(), func.sum(expr),
+            ).group_by(model.user_id).all()
+            for user_id, count, karma in rows:
+                s = stats.setdefault(user_id, dict.fromkeys(
+                    ("post_count", "post_karma", "comment_count", "comment_karma"), 0))
+                s[kind + "_count"] += count
+                s[kind + "_karma"] += karma or 0
+    database.session.query(db.User).update({
+        db.User.post_count: 0,
+        db.User.post_karma: 0,
+        db.User.comment_count: 0,
+        db.User.comment_karma: 0,
+        db.User.unread_notifs: _unread(),
+    }, synchronize_session=False)
+    if stats:
+        database.session.execute(
+            update(db.User), [dict(id=user_id, **s) for user_id, s in stats.items()])
+    database.session.commit()
 
-from app import db
 
 def reset_db():
     db.drop_all()
-    db.create_all()
-    print('Database reset')
+
 
 if __name__ == '__main__':
     reset_db()
@@ -1,14 +1,81 @@
-from flask import g, current_app
-from sqlalchemy import Column, DateTime, Integer, Boolean, Text, String, ForeignKey, create_engine
+from contextvars import ContextVar
+
+from flask import g, current_app, has_request_context, request
+from sqlalchemy import BigInteger, Column, DateTime, Float, Integer, Boolean, Text, String, ForeignKey, Index, LargeBinary, UniqueConstraint, Table, create_engine, inspect
+from sqlalchemy.dialects.mysql import DATETIME, LONGBLOB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, query_expression
 from sqlalchemy.sql import func
+from sqlalchemy.sql.dml import UpdateBase
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+
+# ----------------------------
+# SHARD ROUTING
+# ----------------------------
+
+# tables split by community across the SHARDS binds, see shards.py. every
+# other table stays on the main database, which is also shard 0
+SHARDED = frozenset((
+    "posts", "comments", "votes", "comment_votes",
+    "archived_posts", "archived_comments",
+))
+
+# their ids carry the shard in the high bits. columns pointing at them take
+# the type from the foreign key. sqlite only autoincrements INTEGER keys
+ShardId = BigInteger().with_variant(Integer, "sqlite")
+
+# set by shards.using(), otherwise the request's shard
+current = ContextVar("shard", default=None)
+
+
+class ShardError(Exception):
+    pass
+
+
+def current_shard():
+    shard = current.get()
+    if shard is None and has_request_context():
+        shard = request.environ.get("mosaic.shard")
+    return shard
 
-database = SQLAlchemy()
+
+class ShardSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kws):
+        if bind is None:
+            table = _table(mapper, clause)
+            if table is not None and table.name in SHARDED:
+                return self._shard_engine(table)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kws)
+
+    def _shard_engine(self, table):
+        keys = current_app.config.get("SHARDS", [None])
+        shard = current_shard()
+        if shard is None:
+            if len(keys) == 1:
+                return self._db.engines[None]
+            raise ShardError(f"No shard selected for {table.name}")
+        return self._db.engines[keys[shard]]
+
+
+def _table(mapper, clause):
+    if mapper is not None:
+        return inspect(mapper).local_table
+    if isinstance(clause, Table):
+        return clause
+    if isinstance(clause, UpdateBase) and isinstance(clause.table, Table):
+        return clause.table
+    return None
+
+
+database = SQLAlchemy(session_options={"class_": ShardSession})
 
 Base = declarative_base()
 
+# mysql's DATETIME drops the fraction, times compared with each other within
+# the same second need it
+PreciseDateTime = DateTime().with_variant(DATETIME(fsp=6), "mysql")
+
 
 class User(database.Model):
     __tablename__ = "users"
@@ -21,24 +88,41 @@ class User(database.Model):
     last_login = Column(DateTime, server_default=func.now())
     time_joined = Column(DateTime, server_default=func.now())
     user_status = Column(Integer)
+    post_karma = Column(Integer, default=0, server_default="0")
+    comment_karma = Column(Integer, default=0, server_default="0")
+    post_count = Column(Integer, default=0, server_default="0")
+    comment_count = Column(Integer, default=0, server_default="0")
+    # kept in step with notifications.is_read, never counted
+    unread_notifs = Column(Integer, default=0, server_default="0")
+    # next history slot and the last /me/history/clear, see history.py
+    history_seq = Column(Integer, default=0, server_default="0")
+    history_cleared_at = Column(PreciseDateTime)
 
 
 class Vote(database.Model):
+    # one row per (post, user), clustered by post. the user index also holds
+    # the direction, so a user's votes are read from the index alone.
+    # time is kept for archive.candidates
     __tablename__ = "votes"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ix_votes_user_id_post_id", "user_id", "post_id", "upvote"),
+        # clustered by the key like innodb, not a rowid table plus a key index
+        {"sqlite_with_rowid": False},
+    )
     post_id = Column(ForeignKey(
-        "posts.id", ondelete="CASCADE"), nullable=False)
-    time = Column(DateTime, server_default=func.now())
+        "posts.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
     user_id = Column(ForeignKey(
-        "users.id", ondelete="CASCADE"), nullable=False)
-    upvote = Column(Boolean)
+        "users.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    upvote = Column(Boolean, nullable=False)
+    time = Column(DateTime, server_default=func.now())
     user = relationship("User", foreign_keys="Vote.user_id")
     post = relationship("Post", foreign_keys="Vote.post_id")
 
 
 class Post(database.Model):
     __tablename__ = "posts"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(ShardId, primary_key=True, index=True)
     content = Column(Text)
     display_pic = Column(Text)
     downvotes = Column(Integer, default=0)
@@ -47,10 +131,14 @@ class Post(database.Model):
     title = Column(Text)
     upvotes = Column(Integer, default=0)
     view_count = Column(Integer, default=0)
+    # last comment vote, at most a day off, see archive.touch
+    last_activity = Column(DateTime)
     user_id = Column(ForeignKey(
         "users.id", ondelete="CASCADE"), nullable=False)
     community_id = Column(ForeignKey(
         "communities.id", ondelete="CASCADE"), nullable=False)
+    # only loaded by list queries asking for ?fields=excerpt
+    excerpt = query_expression()
     user = relationship("User", foreign_keys="Post.user_id")
     community = relationship("Community", foreign_keys="Post.community_id")
 
@@ -65,6 +153,8 @@ class Community(database.Model):
     is_deleted = Column(Boolean, default=0)
     time_created = Column(DateTime, server_default=func.now())
     sub_count = Column(Integer, default=1)
+    # where its posts and comments live, set once at creation
+    shard = Column(Integer, default=0, server_default="0")
     admin_id = Column(ForeignKey(
         "users.id", ondelete="CASCADE"), nullable=False)
     created_by_id = Column(ForeignKey(
@@ -75,7 +165,12 @@ class Community(database.Model):
 
 class Comment(database.Model):
     __tablename__ = "comments"
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        # ?sort=best pages, see ranking.py
+        Index("ix_comments_post_id_parent_comment_score", "post_id", "parent_comment", "score"),
+        {"sqlite_autoincrement": True},
+    )
+    id = Column(ShardId, primary_key=True, index=True)
     content = Column(Text)
     downvotes = Column(Integer, default=0)
     is_deleted = Column(Boolean)
@@ -83,6 +178,8 @@ class Comment(database.Model):
         "comments.id", ondelete="CASCADE"), nullable=True)
     time_created = Column(DateTime, server_default=func.now())
     upvotes = Column(Integer, default=0)
+    # wilson lower bound of upvotes/downvotes, kept by the vote handlers
+    score = Column(Float, default=0, server_default="0")
     user_id = Column(ForeignKey(
         "users.id", ondelete="CASCADE"), nullable=False)
     post_id = Column(ForeignKey(
@@ -105,17 +202,149 @@ class SubscribedCommunity(database.Model):
 
 
 class CommentVote(database.Model):
+    # same layout as Vote without the time, a vote bumps
+    # Post.last_activity instead
     __tablename__ = "comment_votes"
-    id = Column(Integer, primary_key=True, index=True)
-    time = Column(DateTime, server_default=func.now())
-    is_upvote = Column(Boolean)
-    user_id = Column(ForeignKey(
-        "users.id", ondelete="CASCADE"), nullable=False)
+    __table_args__ = (
+        Index("ix_comment_votes_user_id_comment_id", "user_id", "comment_id", "is_upvote"),
+        {"sqlite_with_rowid": False},
+    )
     comment_id = Column(ForeignKey(
-        "comments.id", ondelete="CASCADE"), nullable=False)
+        "comments.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True, autoincrement=False)
+    is_upvote = Column(Boolean, nullable=False)
     user = relationship("User", foreign_keys="CommentVote.user_id")
     comment = relationship("Comment", foreign_keys="CommentVote.comment_id")
 
+
+class Notification(database.Model):
+    __tablename__ = "notifications"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    actor_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    # no foreign keys, the post and comment may be archived or on another
+    # shard. notify.forget removes the rows when they're deleted
+    post_id = Column(ShardId, nullable=False)
+    comment_id = Column(ShardId, nullable=False)
+    community_id = Column(Integer)
+    content = Column(Text)
+    is_read = Column(Boolean, default=False)
+    time_created = Column(DateTime, server_default=func.now())
+    user = relationship("User", foreign_keys="Notification.user_id")
+    actor = relationship("User", foreign_keys="Notification.actor_id")
+    # a user's notifications newest first, the only way they're read
+    __table_args__ = (Index("ix_notifications_user_id_id", "user_id", "id"),)
+
+
+class ArchivedPost(database.Model):
+    # a post and its comments frozen by archive.py, written once and never
+    # updated. data is the zlib compressed json document
+    __tablename__ = "archived_posts"
+    id = Column(ShardId, primary_key=True, autoincrement=False)
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    community_id = Column(Integer, nullable=False)
+    time_created = Column(DateTime)
+    archived_at = Column(DateTime, server_default=func.now())
+    # upvotes - downvotes, for cron.reconcile_user_stats
+    karma = Column(Integer, default=0)
+    data = Column(LargeBinary().with_variant(LONGBLOB(), "mysql"), nullable=False)
+    __table_args__ = (
+        Index("ix_archived_posts_user_id_id", "user_id", "id"),
+        Index("ix_archived_posts_community_id_id", "community_id", "id"),
+    )
+
+
+class ArchivedComment(database.Model):
+    # where an archived comment's document is, plus what user pages and
+    # karma need without opening it
+    __tablename__ = "archived_comments"
+    id = Column(ShardId, primary_key=True, autoincrement=False)
+    post_id = Column(ForeignKey(
+        "archived_posts.id", ondelete="CASCADE"), nullable=False)
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    time_created = Column(DateTime)
+    karma = Column(Integer, default=0)
+    __table_args__ = (Index("ix_archived_comments_user_id_id", "user_id", "id"),)
+
+
+class HistoryEntry(database.Model):
+    __tablename__ = "history"
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), primary_key=True)
+    slot = Column(Integer, primary_key=True, autoincrement=False)
+    # no foreign key, the post may be archived or on another shard
+    post_id = Column(ShardId, nullable=False)
+    viewed_at = Column(PreciseDateTime, nullable=False)
+
+
+class SavedPost(database.Model):
+    __tablename__ = "saved_posts"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, server_default=func.now())
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    # no foreign key, the post may be archived or on another shard
+    post_id = Column(ShardId, nullable=False)
+    user = relationship("User", foreign_keys="SavedPost.user_id")
+    __table_args__ = (
+        UniqueConstraint("user_id", "post_id"),
+        Index("ix_saved_posts_user_id_id", "user_id", "id"),
+    )
+
+
+class SavedComment(database.Model):
+    __tablename__ = "saved_comments"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, server_default=func.now())
+    user_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    # no foreign key, the comment may be archived or on another shard
+    comment_id = Column(ShardId, nullable=False)
+    user = relationship("User", foreign_keys="SavedComment.user_id")
+    __table_args__ = (
+        UniqueConstraint("user_id", "comment_id"),
+        Index("ix_saved_comments_user_id_id", "user_id", "id"),
+    )
+
+
+class Follow(database.Model):
+    __tablename__ = "follows"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, server_default=func.now())
+    follower_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    following_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    follower = relationship("User", foreign_keys="Follow.follower_id")
+    following = relationship("User", foreign_keys="Follow.following_id")
+    __table_args__ = (UniqueConstraint("follower_id", "following_id"),)
+
+
+class Block(database.Model):
+    __tablename__ = "blocks"
+    id = Column(Integer, primary_key=True)
+    time = Column(DateTime, server_default=func.now())
+    blocked_by_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    blocked_id = Column(ForeignKey(
+        "users.id", ondelete="CASCADE"), nullable=False)
+    blocked_by = relationship("User", foreign_keys="Block.blocked_by_id")
+    blocked = relationship("User", foreign_keys="Block.blocked_id")
+    __table_args__ = (UniqueConstraint("blocked_by_id", "blocked_id"),)
+
+
+class JobLease(database.Model):
+    __tablename__ = "job_leases"
+    name = Column(String(64), primary_key=True)
+    owner = Column(String(128))
+    expires_at = Column(DateTime)
+
+
 def drop_all():
     database.drop_all()
     database.create_all()
@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+from collections import deque
+
+# ----------------------------
+# LIVE EVENTS
+# ----------------------------
+
+# in-process pub/sub feeding the per-post server-sent events stream. write
+# handlers publish; every subscriber has its own bounded buffer where vote
+# updates for the same target replace each other and new comments queue up
+# to max_pending (past that the client is told to resync). subscribers
+# flush at most once per `interval`. events reach the other workers over the
+# cache invalidation bus.
+#
+# a connection only parks in Event.wait between flushes, so under the gevent
+# worker class (WORKER_CLASS=gevent) idle streams cost a greenlet each, not a
+# thread.
+
+PREFIX = "event:"
+
+
+class Subscriber:
+    __slots__ = ("post_id", "votes", "comments", "overflow", "wake")
+
+    def __init__(self, post_id, max_pending):
+        self.post_id = post_id
+        # (kind, id) -> latest payload
+        self.votes = {}
+        self.comments = deque(maxlen=max_pending)
+        self.overflow = False
+        self.wake = threading.Event()
+
+    def push(self, kind, data):
+        if kind.endswith("_votes"):
+            self.votes[(kind, data["id"])] = data
+        else:
+            if len(self.comments) == self.comments.maxlen:
+                self.overflow = True
+            self.comments.append((kind, data))
+        self.wake.set()
+
+    def drain(self):
+        self.wake.clear()
+        if self.overflow:
+            self.overflow = False
+            self.votes = {}
+            self.comments.clear()
+            return [("resync", {"post": self.post_id})]
+        events = list(self.comments)
+        self.comments.clear()
+        events.extend((kind, data) for (kind, _), data in self.votes.items())
+        self.votes = {}
+        return events
+
+
+class EventHub:
+    def __init__(self, bus=None, app=None, interval=0.5, max_pending=100, heartbeat=15):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.published = 0
+        self.delivered = 0
+        self._subs = {}
+        self._lock = threading.Lock()
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.interval = app.config.get("EVENTS_INTERVAL", self.interval)
+        self.max_pending = app.config.get("EVENTS_MAX_PENDING", self.max_pending)
+
+    def publish(self, post_id, kind, data):
+        self.published += 1
+        self._deliver(post_id, kind, data)
+        if self.bus is not None:
+            self.bus.publish([PREFIX + json.dumps([post_id, kind, data])])
+
+    def subscribe(self, post_id):
+        sub = Subscriber(post_id, self.max_pending)
+        with self._lock:
+            self._subs.setdefault(post_id, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.post_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subs[sub.post_id]
+
+    def stream(self, sub):
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if not sub.wake.wait(self.heartbeat):
+                    yield ": ping\n\n"
+                    continue
+                # let a burst of writes collapse into one flush
+                time.sleep(self.interval)
+                with self._lock:
+                    events = sub.drain()
+                yield "".join(
+                    f"event: {kind}\ndata: {json.dumps(data)}\n\n" for kind, data in events)
+        finally:
+            self.unsubscribe(sub)
+
+    def to_dict(self):
+        return {
+            "posts": len(self._subs),
+            "subscribers": sum(len(s) for s in self._subs.values()),
+            "published": self.published,
+            "delivered": self.delivered,
+        }
+
+    def _deliver(self, post_id, kind, data):
+        with self._lock:
+            for sub in self._subs.get(post_id, ()):
+                sub.push(kind, data)
+                self.delivered += 1
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith(PREFIX):
+                post_id, kind, data = json.loads(key[len(PREFIX):])
+                self._deliver(post_id, kind, data)
@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import insert
+
+import db
+from db import database
+
+# ----------------------------
+# BROWSING HISTORY
+# ----------------------------
+
+# post views are buffered per worker and written in batches. each user's
+# history is a ring of `size` rows in the history table keyed by
+# (user_id, slot); users.history_seq says where the next view goes, so a
+# flush overwrites the oldest slots instead of growing the table. clearing
+# only moves users.history_cleared_at, rows older than that are never read
+# again and get overwritten as new views come in.
+
+
+class HistoryBuffer:
+    def __init__(self, app=None, size=100, interval=5, max_pending=5000):
+        self.size = size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.recorded = 0
+        self.flushed = 0
+        self.flushes = 0
+        # user id -> post id -> viewed at, oldest first
+        self._pending = {}
+        self._count = 0
+        self._last_flush = time.monotonic()
+        # a flush was asked for and hasn't run yet
+        self._flush_pending = False
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config.get("HISTORY_SIZE", self.size)
+        self.interval = app.config.get("HISTORY_FLUSH_INTERVAL", self.interval)
+        self.max_pending = app.config.get("HISTORY_MAX_PENDING", self.max_pending)
+
+    def record(self, user_id, post_id):
+        # returns True when the buffer is due for a flush, once, until the
+        # flush runs
+        with self._lock:
+            views = self._pending.setdefault(user_id, OrderedDict())
+            if views.pop(post_id, None) is None:
+                self._count += 1
+            views[post_id] = datetime.now()
+            if len(views) > self.size:
+                views.popitem(last=False)
+                self._count -= 1
+            self.recorded += 1
+            if self._flush_pending:
+                return False
+            due = self._count >= self.max_pending or \
+                time.monotonic() - self._last_flush >= self.interval
+            self._flush_pending = due
+            return due
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._count = 0
+            self._last_flush = time.monotonic()
+            self._flush_pending = False
+        if not pending:
+            return 0
+        rows = []
+        # same lock order in every worker
+        for user_id in sorted(pending):
+            views = list(pending[user_id].items())
+            database.session.query(db.User).filter(db.User.id == user_id).update(
+                {db.User.history_seq: db.User.history_seq + len(views)},
+                synchronize_session=False)
+            seq = database.session.query(db.User.history_seq).filter(
+                db.User.id == user_id).scalar()
+            if seq is None:
+                continue
+            first = seq - len(views)
+            slots = [(first + i) % self.size for i in range(len(views))]
+            database.session.query(db.HistoryEntry).filter(
+                db.HistoryEntry.user_id == user_id,
+                db.HistoryEntry.slot.in_(slots)).delete(synchronize_session=False)
+            rows.extend({"user_id": user_id, "slot": slot, "post_id": post_id,
+                         "viewed_at": viewed_at}
+                        for slot, (post_id, viewed_at) in zip(slots, views))
+        if rows:
+            database.session.execute(insert(db.HistoryEntry), rows)
+        database.session.commit()
+        self.flushes += 1
+        self.flushed += len(rows)
+        return len(rows)
+
+    def recent(self, user_id):
+        # post ids, most recently viewed first. views still buffered in other
+        # workers show up after their next flush
+        cleared = database.session.query(db.User.history_cleared_at).filter(
+            db.User.id == user_id).scalar()
+        query = database.session.query(
+            db.HistoryEntry.post_id, db.HistoryEntry.viewed_at).filter(
+            db.HistoryEntry.user_id == user_id)
+        if cleared is not None:
+            query = query.filter(db.HistoryEntry.viewed_at > cleared)
+        views = query.all()
+        with self._lock:
+            views.extend(self._pending.get(user_id, {}).items())
+        latest = {}
+        for post_id, viewed_at in views:
+            if cleared is not None and viewed_at <= cleared:
+                continue
+            if latest.get(post_id, viewed_at) <= viewed_at:
+                latest[post_id] = viewed_at
+        return sorted(latest, key=latest.get, reverse=True)[:self.size]
+
+    def clear(self, user_id):
+        with self._lock:
+            self._count -= len(self._pending.pop(user_id, ()))
+        database.session.query(db.User).filter(db.User.id == user_id).update(
+            {db.User.history_cleared_at: datetime.now()}, synchronize_session=False)
+        database.session.commit()
+
+    def to_dict(self):
+        return {
+            "pending_users": len(self._pending),
+            "pending_views": self._count,
+            "recorded": self.recorded,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "size": self.size,
+        }
@@ -0,0 +1,124 @@
+import hashlib
+import sqlite3
+import time
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from admission import reject
+
+# ----------------------------
+# IDEMPOTENCY KEYS
+# ----------------------------
+
+# clients retrying a write send the same Idempotency-Key header. the first
+# request with a key claims it in the shared store and runs; its response is
+# stored there for `ttl` seconds and handed back to every repeat without
+# running the handler again. a repeat that arrives while the first is still
+# running waits up to `wait` seconds for it. keys are per user and route, and
+# a key sent again with a different body is refused. 5xx responses and ones
+# asking to retry (429, a 409 vote conflict) aren't stored, the retry runs
+# for real.
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+class Idempotency:
+    def __init__(self, store, app=None):
+        self.store = store
+        self.ttl = 24 * 60 * 60
+        self.wait = 10
+        # a claim left by a worker that died mid request is free after this
+        self.lock_ttl = 60
+        self.stored = 0
+        self.replayed = 0
+        self.waited = 0
+        self.mismatched = 0
+        self.timed_out = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("IDEMPOTENCY_TTL", self.ttl)
+        self.wait = app.config.get("IDEMPOTENCY_WAIT", self.wait)
+
+    def keyed(self, f):
+        # must go below @authorize, keys are per user. above admission.limit
+        # so a replay doesn't spend the user's tokens
+        @wraps(f)
+        def decorated_function(*args, user=None, **kws):
+            header = request.headers.get(HEADER)
+            if not header:
+                return f(*args, user=user, **kws)
+            if len(header) > MAX_KEY_LENGTH:
+                return {"error": f"{HEADER} is too long"}, 400
+            key = f"{user['id']}:{request.method}:{request.path}:{header}"
+            fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+            try:
+                row = self._claim(key, fingerprint)
+            except sqlite3.Error:
+                # don't fail the write because the store is locked
+                return f(*args, user=user, **kws)
+            if row is not None:
+                return row
+            try:
+                resp = make_response(f(*args, user=user, **kws))
+            except Exception:
+                self._release(key)
+                raise
+            if resp.status_code >= 500 or "Retry-After" in resp.headers or resp.is_streamed:
+                self._release(key)
+                return resp
+            try:
+                self.store.finish(key, resp.status_code, resp.content_type,
+                                  resp.get_data(), self.ttl)
+                self.stored += 1
+            except sqlite3.Error:
+                self._release(key)
+            return resp
+        return decorated_function
+
+    def _claim(self, key, fingerprint):
+        # None once the caller owns the key, otherwise the response to send
+        deadline = time.monotonic() + self.wait
+        delay = 0.02
+        waited = False
+        while True:
+            row = self.store.claim(key, fingerprint, self.lock_ttl)
+            if row is None:
+                return None
+            stored_fingerprint, status, content_type, body = row
+            if stored_fingerprint != fingerprint:
+                self.mismatched += 1
+                return {"error": f"{HEADER} was already used for a different request"}, 422
+            if status is not None:
+                self.replayed += 1
+                resp = Response(body, status=status, content_type=content_type)
+                resp.headers["Idempotent-Replayed"] = "true"
+                return resp
+            if time.monotonic() >= deadline:
+                self.timed_out += 1
+                return reject(409, "A request with this Idempotency-Key is still running", 1)
+            if not waited:
+                waited = True
+                self.waited += 1
+            time.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+    def _release(self, key):
+        try:
+            self.store.release(key)
+        except sqlite3.Error:
+            # the claim runs out after lock_ttl
+            pass
+
+    def to_dict(self):
+        return {
+            "stored": self.stored,
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "mismatched": self.mismatched,
+            "timed_out": self.timed_out,
+            "ttl": self.ttl,
+        }
@@ -0,0 +1,317 @@
+import os
+import queue
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import request
+from sqlalchemy.exc import IntegrityError
+
+import db
+from db import database
+
+# ----------------------------
+# BACKGROUND JOBS
+# ----------------------------
+
+# every worker process runs its own JobRunner. periodic jobs take a lease row
+# in job_leases before running so only one of the workers runs a given job
+# per interval, unless they're local (per-process work like flushing a
+# buffer). queued jobs are local to the process that queued them.
+#
+# jobs back off while JOBS_MAX_BUSY requests are in flight in the worker,
+# by default as many as it can have doing db work at once (WORKER_SLOTS),
+# and run anyway once they've waited JOBS_MAX_DEFER seconds. a full queue
+# drops the job, callers don't fall back to running it in the request.
+# batch() collects the items of one kind of job and runs them together, so
+# it never fills up.
+
+
+class Job:
+    def __init__(self, name, fn, interval, jitter, lease, local=False):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.jitter = jitter
+        self.lease = lease
+        self.local = local
+        self.next_run = 0
+        self.deferred_since = None
+
+    def schedule(self, now):
+        spread = self.interval * self.jitter
+        self.next_run = now + self.interval + random.uniform(-spread, spread)
+
+
+class JobStats:
+    def __init__(self):
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.total_time = 0.0
+        self.last_time = 0.0
+        self.max_time = 0.0
+        self.last_run = None
+
+    def record(self, elapsed, ok):
+        self.runs += 1
+        if not ok:
+            self.failures += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.last_run = datetime.now().isoformat()
+
+    def to_dict(self):
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "total_ms": round(self.total_time * 1000, 2),
+            "last_ms": round(self.last_time * 1000, 2),
+            "max_ms": round(self.max_time * 1000, 2),
+            "avg_ms": round(self.total_time * 1000 / self.runs, 2) if self.runs else 0,
+            "last_run": self.last_run,
+        }
+
+
+class JobRunner:
+    def __init__(self, app=None, max_queue=256, max_busy=4, max_defer=60):
+        self.app = None
+        self.jobs = {}
+        self.stats = {}
+        self.max_busy = max_busy
+        self.max_defer = max_defer
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        # name -> (fn, [items]) for batch()
+        self._batches = {}
+        self.max_batch = max_queue * 16
+        self._busy = 0
+        self._busy_lock = threading.Lock()
+        self._exempt = set()
+        self._stop = threading.Event()
+        self._thread = None
+        self.owner = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_busy = app.config.get(
+            "JOBS_MAX_BUSY", app.config.get("WORKER_SLOTS", self.max_busy))
+        self.max_defer = app.config.get("JOBS_MAX_DEFER", self.max_defer)
+
+        # count in-flight requests so jobs can back off while requests are
+        # being served
+        @app.before_request
+        def _job_busy_enter():
+            if request.endpoint in self._exempt:
+                return
+            request.environ["mosaic.job_busy"] = True
+            with self._busy_lock:
+                self._busy += 1
+
+        # teardown can run more than once for a request (streamed responses
+        # push the context again), only count the first
+        @app.teardown_request
+        def _job_busy_exit(exc=None):
+            if request.environ.pop("mosaic.job_busy", False):
+                with self._busy_lock:
+                    self._busy -= 1
+
+    def exempt(self, f):
+        # long lived requests (event streams) that shouldn't hold jobs back
+        self._exempt.add(f.__name__)
+        return f
+
+    def periodic(self, name, interval, jitter=0.1, lease=None, local=False):
+        def decorator(f):
+            self.jobs[name] = Job(name, f, interval, jitter, lease or interval, local)
+            self.stats[name] = JobStats()
+            return f
+        return decorator
+
+    def enqueue(self, name, f, *args, **kws):
+        # returns False when the runner isn't started (JOBS_ENABLED=0), so
+        # callers can do the work inline. a full queue drops the job and
+        # still returns True, running it in the request is what the queue
+        # is there to avoid
+        if name not in self.stats:
+            self.stats[name] = JobStats()
+        if self._thread is None:
+            return False
+        try:
+            self._queue.put_nowait((name, f, args, kws))
+        except queue.Full:
+            self.dropped += 1
+        return True
+
+    def batch(self, name, f, item):
+        # f(item) for every item added, run by the runner, items added while
+        # it's busy wait in one list instead of a queue slot each. same
+        # return value as enqueue()
+        if name not in self.stats:
+            self.stats[name] = JobStats()
+        if self._thread is None:
+            return False
+        with self._busy_lock:
+            _, items = self._batches.setdefault(name, (f, []))
+            if len(items) < self.max_batch:
+                items.append(item)
+            else:
+                self.dropped += 1
+        return True
+
+    def busy(self):
+        return self._busy >= self.max_busy
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        # computed here rather than in __init__ so forked workers get their
+        # own identity
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        now = time.monotonic()
+        for job in self.jobs.values():
+            # spread the first run so workers started together don't all
+            # race for the lease at the same moment
+            job.next_run = now + random.uniform(0, job.interval * max(job.jitter, 0.1))
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="job-runner", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_now(self, name):
+        job = self.jobs[name]
+        with self.app.app_context():
+            self._run(job.name, job.fn, (), {})
+
+    def to_dict(self):
+        return {
+            "owner": self.owner,
+            "queued": self._queue.qsize(),
+            "batched": sum(len(items) for _, items in self._batches.values()),
+            "dropped": self.dropped,
+            "in_flight_requests": self._busy,
+            "jobs": {name: s.to_dict() for name, s in self.stats.items()},
+        }
+
+    def _loop(self):
+        while not self._stop.is_set():
+            now = time.monotonic()
+            due = [j for j in self.jobs.values() if j.next_run <= now]
+            wait = min([j.next_run for j in self.jobs.values()], default=now + 1) - now
+            if not due:
+                self._run_batches()
+                try:
+                    item = self._queue.get(timeout=max(min(wait, 1), 0.01))
+                except queue.Empty:
+                    continue
+                self._run_queued(item)
+                continue
+            for job in due:
+                if self._stop.is_set():
+                    return
+                if not self._should_run(job, now):
+                    continue
+                job.deferred_since = None
+                job.schedule(time.monotonic())
+                with self.app.app_context():
+                    if job.local or self._acquire(job):
+                        self._run(job.name, job.fn, (), {})
+                    else:
+                        self.stats[job.name].skipped += 1
+            # drain a bit of the queue between periodic jobs
+            for _ in range(16):
+                if self.busy() or self._stop.is_set():
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._run_queued(item)
+
+    def _should_run(self, job, now):
+        if not self.busy():
+            return True
+        if job.deferred_since is None:
+            job.deferred_since = now
+        if now - job.deferred_since >= self.max_defer:
+            return True
+        job.next_run = now + 0.05
+        return False
+
+    def _run_queued(self, item):
+        self._wait_idle()
+        name, f, args, kws = item
+        with self.app.app_context():
+            self._run(name, f, args, kws)
+
+    def _run_batches(self):
+        with self._busy_lock:
+            ready = [(name, f, items) for name, (f, items) in self._batches.items() if items]
+            for name, f, items in ready:
+                self._batches[name] = (f, [])
+        if not ready:
+            return
+        self._wait_idle()
+        for name, f, items in ready:
+            with self.app.app_context():
+                self._run(name, _each, (f, items), {})
+
+    def _wait_idle(self):
+        # like periodic jobs, don't wait out a busy worker for more than
+        # max_defer
+        start = time.monotonic()
+        while self.busy() and not self._stop.is_set() and \
+                time.monotonic() - start < self.max_defer:
+            self._stop.wait(0.05)
+
+    def _run(self, name, f, args, kws):
+        start = time.perf_counter()
+        ok = True
+        try:
+            f(*args, **kws)
+        except Exception as e:
+            ok = False
+            database.session.rollback()
+            print(f"job {name} failed: {e}")
+        finally:
+            database.session.remove()
+        self.stats[name].record(time.perf_counter() - start, ok)
+
+    def _acquire(self, job):
+        now = datetime.now()
+        expires = now + timedelta(seconds=job.lease)
+        try:
+            taken = database.session.query(db.JobLease).filter(
+                db.JobLease.name == job.name,
+                (db.JobLease.expires_at < now) | (db.JobLease.owner == self.owner)
+            ).update({"owner": self.owner, "expires_at": expires},
+                     synchronize_session=False)
+            if taken == 0:
+                database.session.add(db.JobLease(
+                    name=job.name, owner=self.owner, expires_at=expires))
+            database.session.commit()
+            return True
+        except IntegrityError:
+            # another worker holds an unexpired lease
+            database.session.rollback()
+            return False
+
+
+def _each(f, items):
+    for item in items:
+        f(item)
+
+
+runner = JobRunner()
@@ -0,0 +1,56 @@
+from sqlalchemy import func
+
+import db
+from db import database
+
+# ----------------------------
+# USER STATS
+# ----------------------------
+
+# post/comment karma and counts on users are only changed by deltas, in the
+# same session commit as the write that caused them. that is one transaction
+# only on shard 0: users live on the main database, so for a post on another
+# shard the session commits two transactions one after the other, and a
+# failure between them leaves the counts off by that write.
+# cron.reconcile_user_stats recounts them from scratch now and then.
+
+
+def bump(user_id, **deltas):
+    values = {getattr(db.User, k): getattr(db.User, k) + v
+              for k, v in deltas.items() if v}
+    if values:
+        # without flushing the caller's pending rows first: a vote that lost
+        # a race must fail in its commit, where the handler turns it into a
+        # 409, not here
+        with database.session.no_autoflush:
+            database.session.query(db.User).filter(db.User.id == user_id).update(
+                values, synchronize_session=False)
+
+
+def forget_comments(*criteria):
+    # undo the stats of the comments matching criteria, call before deleting
+    # them. returns the ids of the users touched
+    rows = database.session.query(
+        db.Comment.user_id, func.count(),
+        func.sum(db.Comment.upvotes - db.Comment.downvotes),
+    ).filter(*criteria).group_by(db.Comment.user_id).all()
+    for user_id, count, karma in rows:
+        bump(user_id, comment_count=-count, comment_karma=-(karma or 0))
+    return set(r[0] for r in rows)
+
+
+def forget_post(post):
+    bump(post.user_id, post_count=-1,
+         post_karma=-((post.upvotes or 0) - (post.downvotes or 0)))
+    return forget_comments(db.Comment.post_id == post.id) | {post.user_id}
+
+
+def subtree(comment_id):
+    # the comment and every reply below it, these go with it on delete
+    ids = [comment_id]
+    level = [comment_id]
+    while level:
+        level = [x[0] for x in database.session.query(db.Comment.id).filter(
+            db.Comment.parent_comment.in_(level)).all()]
+        ids.extend(level)
+    return ids
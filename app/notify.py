@@ -0,0 +1,98 @@
+from sqlalchemy import func
+
+import db
+import karma
+import shards
+from db import database
+
+# ----------------------------
+# NOTIFICATIONS
+# ----------------------------
+
+# a new comment notifies whoever it replies to: the parent comment's author,
+# or the post's author for top level comments. the rows are written by a
+# queued job so create_comment doesn't wait on them. users.unread_notifs is
+# moved in the same transaction as every insert, read or delete of an unread
+# notification, so the unread badge is a primary key lookup.
+
+EXCERPT = 200
+
+
+def recipients(comment_user_id, post_user_id, parent_id):
+    if parent_id is not None:
+        target = database.session.query(db.Comment.user_id).filter_by(
+            id=parent_id).scalar()
+    else:
+        target = post_user_id
+    if target is not None and database.session.query(db.Block.id).filter_by(
+            blocked_by_id=target, blocked_id=comment_user_id).first() is not None:
+        return set()
+    return {target} - {comment_user_id, None}
+
+
+def fan_out(comment_id):
+    with shards.using(shards.of_id(comment_id)):
+        return _fan_out(comment_id)
+
+
+def _fan_out(comment_id):
+    row = database.session.query(
+        db.Comment.user_id, db.Comment.post_id, db.Comment.parent_comment,
+        db.Comment.content, db.Post.user_id, db.Post.community_id,
+    ).join(db.Post, db.Post.id == db.Comment.post_id).filter(
+        db.Comment.id == comment_id).first()
+    if row is None:
+        # deleted before the job ran
+        return set()
+    user_id, post_id, parent_id, content, post_user_id, community_id = row
+    users = recipients(user_id, post_user_id, parent_id)
+    database.session.add_all(db.Notification(
+        user_id=target, actor_id=user_id, post_id=post_id,
+        comment_id=comment_id, community_id=community_id,
+        content=(content or "")[:EXCERPT], is_read=False,
+    ) for target in users)
+    for target in users:
+        karma.bump(target, unread_notifs=1)
+    database.session.commit()
+    return users
+
+
+def page(user_id, before=None, limit=25):
+    # newest first, `before` is the last id of the previous page
+    query = database.session.query(db.Notification).filter(
+        db.Notification.user_id == user_id)
+    if before is not None:
+        query = query.filter(db.Notification.id < before)
+    rows = query.order_by(db.Notification.id.desc()).limit(limit + 1).all()
+    cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], cursor
+
+
+def unread(user_id):
+    return database.session.query(db.User.unread_notifs).filter(
+        db.User.id == user_id).scalar() or 0
+
+
+def mark_read(user_id, up_to=None):
+    query = database.session.query(db.Notification).filter(
+        db.Notification.user_id == user_id,
+        db.Notification.is_read.is_(False))
+    if up_to is not None:
+        query = query.filter(db.Notification.id <= up_to)
+    count = query.update({db.Notification.is_read: True},
+                         synchronize_session=False)
+    karma.bump(user_id, unread_notifs=-count)
+    database.session.commit()
+    return count
+
+
+def forget(*criteria):
+    # drop the notifications matching criteria along with the unread counts
+    # they hold, call before deleting the comments or posts they point at
+    rows = database.session.query(db.Notification.user_id, func.count()).filter(
+        *criteria, db.Notification.is_read.is_(False)).group_by(
+        db.Notification.user_id).all()
+    for user_id, count in rows:
+        karma.bump(user_id, unread_notifs=-count)
+    database.session.query(db.Notification).filter(*criteria).delete(
+        synchronize_session=False)
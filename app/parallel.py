@@ -0,0 +1,171 @@
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# ----------------------------
+# PARALLEL QUERIES
+# ----------------------------
+
+# independent queries of one request run at the same time on a small thread
+# pool in each worker process. every task runs in its own app context, so it
+# has its own session and pooled connection, on the shard the caller had
+# selected. tasks must return plain values (dumps, counts, ids): orm objects
+# are detached once the task's session is closed. tasks never wait in a
+# queue, when no pool thread is free the caller runs the task itself, so a
+# burst falls back to running the queries one after another.
+
+BATCH = 200
+_DONE = object()
+
+
+class Pool:
+    def __init__(self, app=None, workers=4):
+        self.app = None
+        self.workers = workers
+        self.parallel = 0
+        self.inline = 0
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.get("PARALLEL_WORKERS", self.workers)
+
+    def run(self, *fns):
+        # [fn() for fn in fns], the first in this thread, the rest on the pool
+        futures = [self._submit(fn) for fn in fns[1:]]
+        results = [fns[0]()] if fns else []
+        for fn, future in zip(fns[1:], futures):
+            results.append(fn() if future is None else future.result())
+        return results
+
+    def prefetch(self, fn, depth=4):
+        # iterate fn() on the pool, up to `depth` batches ahead of the caller,
+        # e.g. the second half of a streamed response while the first half is
+        # still being sent
+        q = queue.Queue(depth)
+        stop = threading.Event()
+
+        def produce():
+            items = fn()
+            try:
+                batch = []
+                for item in items:
+                    batch.append(item)
+                    if len(batch) >= BATCH:
+                        if not _put(q, batch, stop):
+                            return
+                        batch = []
+                if batch:
+                    _put(q, batch, stop)
+                _put(q, _DONE, stop)
+            except BaseException as err:
+                _put(q, err, stop)
+            finally:
+                # closes the cursor when the consumer stopped early
+                close = getattr(items, "close", None)
+                if close is not None:
+                    close()
+
+        if self._submit(produce) is None:
+            return fn()
+        return Prefetched(q, stop)
+
+    def _submit(self, fn):
+        # a future for fn on a free pool thread, None if there isn't one
+        if self.workers <= 0 or getattr(self._local, "inside", False):
+            self.inline += 1
+            return None
+        executor = self._get_executor()
+        if not self._slots.acquire(blocking=False):
+            self.inline += 1
+            return None
+        self.parallel += 1
+        shard = db.current_shard()
+        app = self.app
+
+        def task():
+            self._local.inside = True
+            token = db.current.set(shard)
+            try:
+                with app.app_context():
+                    return fn()
+            finally:
+                db.current.reset(token)
+                self._local.inside = False
+                self._slots.release()
+        try:
+            return executor.submit(task)
+        except RuntimeError:
+            # shutting down
+            self._slots.release()
+            return None
+
+    def _get_executor(self):
+        # threads don't survive a fork, each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="parallel")
+                self._slots = threading.BoundedSemaphore(self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def to_dict(self):
+        return {
+            "workers": self.workers,
+            "parallel": self.parallel,
+            "inline": self.inline,
+        }
+
+
+class Prefetched:
+    # the items of a prefetch. the producer is already running, the caller
+    # must close() this even when it never iterates it (e.g. the client went
+    # away while an earlier part was sent), or the producer keeps its pool
+    # thread, app context and cursor forever
+
+    def __init__(self, q, stop):
+        self._stop = stop
+        self._items = _drain(q, stop)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._items)
+
+    def close(self):
+        self._stop.set()
+        self._items.close()
+
+
+def _drain(q, stop):
+    try:
+        while True:
+            batch = q.get()
+            if batch is _DONE:
+                return
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
@@ -0,0 +1,230 @@
+import json
+import os
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+# ----------------------------
+# SAMPLING PROFILER
+# ----------------------------
+
+# started at runtime, from POST /admin/profile or with SIGUSR2 sent to a
+# worker. while it runs, a sampled share of requests (optionally only one
+# route) register their thread, and a background thread reads those
+# threads' stacks every `interval` seconds. stacks are counted across
+# requests in collapsed form, "route;file:function;... count", which
+# flamegraph.pl and speedscope read as is. each worker writes its counts to
+# PROFILE_DIR when the run ends, GET /admin/profile/folded merges them.
+# when no run is active a request only checks one attribute.
+#
+# under the gevent worker requests are greenlets on one thread. the sampler
+# is still a real thread, a greenlet would only run when requests yield. it
+# reads a suspended request's stack from its greenlet and the running one's
+# from the thread.
+
+SIGNAL_SECONDS = 30
+
+
+class Profiler:
+    def __init__(self, bus=None, app=None, directory="mosaic-profiles"):
+        self.directory = directory
+        self.active = False
+        self.sample = 1.0
+        self.route = None
+        self.interval = 0.005
+        self.until = 0
+        self.requests = 0
+        self.samples = 0
+        self.stacks = Counter()
+        # thread ident or greenlet -> ("METHOD route" of the request it
+        # serves, ident of the os thread it runs on)
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._run = 0
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config.get("PROFILE_DIR", self.directory)
+
+        @app.before_request
+        def _profile_enter():
+            if not self.active:
+                return
+            rule = request.url_rule.rule if request.url_rule is not None else None
+            if self.route is not None and rule != self.route:
+                return
+            if random.random() >= self.sample:
+                return
+            request.environ["mosaic.profiled"] = True
+            self.requests += 1
+            self._threads[_current()] = (f"{request.method} {rule}",
+                                         _original("_thread", "get_ident")())
+
+        @app.teardown_request
+        def _profile_exit(exc=None):
+            if request.environ.pop("mosaic.profiled", False):
+                self._threads.pop(_current(), None)
+
+    def start(self, seconds=SIGNAL_SECONDS, sample=1.0, route=None, interval=0.005,
+              publish=True):
+        with self._lock:
+            self._run += 1
+            run = self._run
+            self.sample = sample
+            self.route = route
+            self.interval = interval
+            self.until = time.monotonic() + seconds
+            self.requests = 0
+            self.samples = 0
+            self.stacks = Counter()
+            self.active = True
+        _original("_thread", "start_new_thread")(self._sampler, (run,))
+        if publish:
+            self._publish({"seconds": seconds, "sample": sample,
+                           "route": route, "interval": interval})
+
+    def stop(self, publish=True):
+        # the sampler notices on its next tick and writes its counts
+        self.until = 0
+        if publish:
+            self._publish(None)
+
+    def install_signal(self):
+        # SIGUSR2 starts a run of every request in this worker, or ends one.
+        # call from the worker's main thread
+        def toggle(signum, frame):
+            if self.active:
+                self.stop(publish=False)
+            else:
+                self.start(publish=False)
+        signal.signal(signal.SIGUSR2, toggle)
+
+    def _sampler(self, run):
+        own = _original("_thread", "get_ident")()
+        sleep = _original("time", "sleep")
+        while time.monotonic() < self.until and run == self._run:
+            frames = sys._current_frames()
+            for who, (route, ident) in list(self._threads.items()):
+                frame = frames.get(ident)
+                if not isinstance(who, int) and who.gr_frame is not None:
+                    # suspended, the thread is running another greenlet
+                    frame = who.gr_frame
+                if frame is None or ident == own:
+                    continue
+                self.stacks[_collapse(route, frame)] += 1
+                self.samples += 1
+            del frames
+            sleep(self.interval)
+        if run == self._run:
+            self.active = False
+            self._threads.clear()
+            self._save()
+
+    def _save(self):
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.folded")
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as f:
+                f.write(_lines(self.stacks))
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def folded(self):
+        # every worker's last run, plus this worker's counts so far
+        total = Counter()
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".folded")]
+        except OSError:
+            names = []
+        own = f"{os.getpid()}.folded"
+        for name in names:
+            if name == own and self.active:
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip("\n").rpartition(" ")
+                        if stack:
+                            total[stack] += int(count)
+            except (OSError, ValueError):
+                pass
+        if self.active:
+            total.update(self.stacks)
+        return _lines(total)
+
+    def clear(self):
+        # drop the files of earlier runs before starting a new one
+        try:
+            for name in os.listdir(self.directory):
+                if name.endswith(".folded"):
+                    os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    def to_dict(self):
+        return {
+            "active": self.active,
+            "remaining": max(0.0, round(self.until - time.monotonic(), 1)) if self.active else 0,
+            "sample": self.sample,
+            "route": self.route,
+            "interval": self.interval,
+            "requests": self.requests,
+            "samples": self.samples,
+            "stacks": len(self.stacks),
+        }
+
+    def _publish(self, settings):
+        if self.bus is not None:
+            self.bus.publish(["profile:" + json.dumps(settings)])
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith("profile:"):
+                settings = json.loads(key[8:])
+                if settings is None:
+                    self.stop(publish=False)
+                else:
+                    self.start(publish=False, **settings)
+
+
+def _current():
+    # the greenlet under a monkey-patched gevent worker, else the thread
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched("threading"):
+            from greenlet import getcurrent
+            return getcurrent()
+    return threading.get_ident()
+
+
+def _original(module, name):
+    # the function gevent's monkey patching replaced, if it did
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        return monkey.get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+def _collapse(route, frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    names.append(route)
+    return ";".join(reversed(names))
+
+
+def _lines(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.orm import load_only, with_expression
+
+import db
+
+# ----------------------------
+# SPARSE FIELDSETS
+# ----------------------------
+
+# list endpoints accept ?fields=id,title,excerpt,upvotes. only the requested
+# columns are selected, everything else stays deferred, and `excerpt` is cut
+# from content by the database so the full text never leaves it.
+
+EXCERPT_LEN = 200
+
+# response key -> Post attribute, keys match what PostSchema dumps
+POST_FIELDS = {
+    "id": "id",
+    "title": "title",
+    "content": "content",
+    "excerpt": "excerpt",
+    "display_pic": "display_pic",
+    "upvotes": "upvotes",
+    "downvotes": "downvotes",
+    "view_count": "view_count",
+    "is_deleted": "is_deleted",
+    "time_created": "time_created",
+    "user": "user_id",
+    "community": "community_id",
+}
+
+
+class FieldError(Exception):
+    pass
+
+
+def requested(arg, allowed=POST_FIELDS):
+    # None means no ?fields=, i.e. the full schema dump
+    if arg is None:
+        return None
+    fields = [f.strip() for f in arg.split(",") if f.strip()]
+    unknown = [f for f in fields if f not in allowed]
+    if unknown or not fields:
+        raise FieldError(f"Unknown fields: {', '.join(unknown)}" if unknown else "No fields")
+    return fields
+
+
+def post_options(fields, extra=()):
+    attrs = set(POST_FIELDS[f] for f in fields if f != "excerpt") | set(extra)
+    opts = [load_only(*[getattr(db.Post, a) for a in attrs])]
+    if "excerpt" in fields:
+        opts.append(with_expression(
+            db.Post.excerpt, func.substr(db.Post.content, 1, EXCERPT_LEN)))
+    return opts
+
+
+def dump_one(obj, fields, mapping=POST_FIELDS):
+    d = {}
+    for f in fields:
+        v = getattr(obj, mapping[f])
+        d[f] = v.isoformat() if isinstance(v, datetime) else v
+    return d
+
+
+def dump(objs, fields, mapping=POST_FIELDS):
+    return [dump_one(o, fields, mapping) for o in objs]
+
+
+def pick(dumped, fields):
+    # the same projection of a post already dumped by PostSchema
+    d = {}
+    for f in fields:
+        if f == "excerpt":
+            content = dumped.get("content")
+            d[f] = content[:EXCERPT_LEN] if content is not None else None
+        else:
+            d[f] = dumped.get(f)
+    return d
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+import time
+import zlib
+
+from flask import g, request
+
+# ----------------------------
+# TRAFFIC CAPTURE
+# ----------------------------
+
+# with RECORD_PATH set, a sample of requests is appended to that file as one
+# compact json line each, for bench/replay.py to play back against a local
+# copy of the app. sampling is by caller, the same users (or addresses for
+# anonymous calls) are kept every time, so their requests stay together in
+# order. the caller is recorded as a user id, never the token, and password
+# fields in bodies are blanked.
+#
+#   {"t": start time, "m": method, "p": path, "q": query string,
+#    "r": route, "u": user id, "b": json body, "s": status,
+#    "d": ms until the body was sent}
+
+REDACTED = "***"
+SAMPLE_BUCKETS = 10000
+
+
+class Recorder:
+    def __init__(self, app=None, sample=0.01, max_body=2048):
+        self.path = None
+        self.sample = sample
+        self.max_body = max_body
+        self.recorded = 0
+        self.skipped = 0
+        self.failed = 0
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.get("RECORD_PATH", self.path)
+        self.sample = app.config.get("RECORD_SAMPLE", self.sample)
+        self.max_body = app.config.get("RECORD_MAX_BODY", self.max_body)
+        if not self.path:
+            return
+
+        @app.before_request
+        def _record_start():
+            # the sub-requests of /batch share its app context, only the
+            # /batch call itself is recorded
+            if g.get("recording"):
+                return
+            g.recording = True
+            request.environ["mosaic.record_start"] = (time.time(), time.perf_counter())
+
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        started = request.environ.pop("mosaic.record_start", None)
+        # event streams never finish, they'd hold a replay thread forever
+        if started is None or request.url_rule is None \
+                or response.mimetype == "text/event-stream" \
+                or request.path.startswith("/admin"):
+            return response
+        user_id = _caller()
+        if not self._sampled(user_id):
+            self.skipped += 1
+            return response
+        wall, start = started
+        line = {
+            "t": round(wall, 3),
+            "m": request.method,
+            "p": request.path,
+            "r": request.url_rule.rule,
+            "s": response.status_code,
+        }
+        if request.query_string:
+            line["q"] = request.query_string.decode("latin-1")
+        if user_id is not None:
+            line["u"] = user_id
+        body = self._body()
+        if body is not None:
+            line["b"] = body
+
+        if not response.is_streamed:
+            self._finish(line, start)
+        else:
+            # timed until the whole body is sent
+            response.call_on_close(lambda: self._finish(line, start))
+        return response
+
+    def _finish(self, line, start):
+        line["d"] = round((time.perf_counter() - start) * 1000, 2)
+        self._write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def _sampled(self, user_id):
+        key = str(user_id) if user_id is not None else (request.remote_addr or "")
+        return zlib.crc32(key.encode()) % SAMPLE_BUCKETS < self.sample * SAMPLE_BUCKETS
+
+    def _body(self):
+        if not request.is_json or request.content_length is None \
+                or request.content_length > self.max_body:
+            return None
+        return _redact(request.get_json(silent=True))
+
+    def _write(self, line):
+        # one append per line, lines from several workers don't interleave
+        try:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                    self._pid = os.getpid()
+                os.write(self._fd, line.encode("utf-8"))
+            self.recorded += 1
+        except OSError:
+            self.failed += 1
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "sample": self.sample,
+            "recorded": self.recorded,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+
+def _caller():
+    # the id from the token the route decoded, see decode_token
+    for claims in g.get("tokens", {}).values():
+        return claims.get("id")
+    return None
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if "password" in k else _redact(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_redact(v) for v in value]
+    return value
@@ -0,0 +1,163 @@
+import math
+
+from sqlalchemy.exc import IntegrityError
+
+import db
+from cache import LRU, Generations
+from db import database
+
+# ----------------------------
+# BLOCKS AND FOLLOWS
+# ----------------------------
+
+# who a user blocks and follows is read on every feed, thread and search
+# request they make, so each worker keeps the lists of recently active users
+# in an LRU. block lists of up to `exact_limit` ids are kept as a frozenset,
+# longer ones as a bloom filter, which hides a user it shouldn't about once
+# in FALSE_POSITIVE lookups. changes drop the entry in every worker through
+# the cache invalidation bus, and a load that raced one isn't kept.
+
+PREFIX = "relations:"
+FALSE_POSITIVE = 0.001
+MASK = (1 << 64) - 1
+
+# model -> (owner column, other user column)
+COLUMNS = {
+    db.Block: ("blocked_by_id", "blocked_id"),
+    db.Follow: ("follower_id", "following_id"),
+}
+
+
+class BloomFilter:
+    __slots__ = ("bits", "m", "k", "n")
+
+    def __init__(self, ids, fp=FALSE_POSITIVE):
+        self.n = max(len(ids), 1)
+        self.m = max(int(-self.n * math.log(fp) / math.log(2) ** 2), 64)
+        self.k = max(round(self.m / self.n * math.log(2)), 1)
+        self.bits = bytearray((self.m + 7) // 8)
+        for x in ids:
+            for i in self._positions(x):
+                self.bits[i >> 3] |= 1 << (i & 7)
+
+    def _positions(self, x):
+        # double hashing, k positions from two multiplicative hashes
+        h1 = (x * 0x9E3779B97F4A7C15) & MASK
+        h2 = ((x ^ (x >> 17)) * 0xC2B2AE3D27D4EB4F) & MASK | 1
+        return [(h1 + i * h2) % self.m for i in range(self.k)]
+
+    def __contains__(self, x):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._positions(x))
+
+    def __bool__(self):
+        return True
+
+
+def make_filter(ids, exact_limit):
+    if len(ids) <= exact_limit:
+        return frozenset(ids)
+    return BloomFilter(ids)
+
+
+class Relations:
+    __slots__ = ("blocked", "following")
+
+    def __init__(self, blocked, following):
+        # `x in blocked` for the user ids to hide, following is a tuple
+        self.blocked = blocked
+        self.following = following
+
+
+NOBODY = Relations(frozenset(), ())
+
+
+class RelationCache:
+    def __init__(self, bus=None, app=None, size=10000, exact_limit=1024, ttl=600):
+        self.exact_limit = exact_limit
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.blooms = 0
+        self._local = LRU(size)
+        self._gens = Generations(size)
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.exact_limit = app.config.get("BLOCK_EXACT_LIMIT", self.exact_limit)
+
+    def get(self, user_id):
+        if user_id is None:
+            return NOBODY
+        rel = self._local.get(user_id)
+        if rel is not None:
+            self.hits += 1
+            return rel
+        self.misses += 1
+        start = self._gens.start()
+        blocked = [r[0] for r in database.session.query(db.Block.blocked_id).filter(
+            db.Block.blocked_by_id == user_id).all()]
+        following = tuple(r[0] for r in database.session.query(db.Follow.following_id).filter(
+            db.Follow.follower_id == user_id).all())
+        rel = Relations(make_filter(blocked, self.exact_limit), following)
+        if isinstance(rel.blocked, BloomFilter):
+            self.blooms += 1
+        if not self._gens.changed(user_id, start):
+            self._local.set(user_id, rel, self.ttl)
+            if self._gens.changed(user_id, start):
+                self._local.delete(user_id)
+        return rel
+
+    def blocked(self, user_id):
+        return self.get(user_id).blocked
+
+    def invalidate(self, user_id):
+        self._gens.bump(user_id)
+        self._local.delete(user_id)
+        if self.bus is not None:
+            self.bus.publish([f"{PREFIX}{user_id}"])
+
+    def to_dict(self):
+        return {
+            "users": len(self._local),
+            "hits": self.hits,
+            "misses": self.misses,
+            "bloom_filters_built": self.blooms,
+            "exact_limit": self.exact_limit,
+        }
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith(PREFIX):
+                self._gens.bump(int(key[len(PREFIX):]))
+                self._local.delete(int(key[len(PREFIX):]))
+
+
+def add(model, user_id, other_id):
+    owner, other = COLUMNS[model]
+    database.session.add(model(**{owner: user_id, other: other_id}))
+    try:
+        database.session.commit()
+    except IntegrityError:
+        # already there
+        database.session.rollback()
+
+
+def remove(model, user_id, other_id):
+    owner, other = COLUMNS[model]
+    database.session.query(model).filter(
+        getattr(model, owner) == user_id,
+        getattr(model, other) == other_id,
+    ).delete(synchronize_session=False)
+    database.session.commit()
+
+
+def usernames(model, user_id):
+    owner, other = COLUMNS[model]
+    rows = database.session.query(db.User.username).join(
+        model, getattr(model, other) == db.User.id).filter(
+        getattr(model, owner) == user_id).order_by(model.id).all()
+    return [r[0] for r in rows]
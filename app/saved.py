@@ -0,0 +1,44 @@
+from sqlalchemy.exc import IntegrityError
+
+import db
+from db import database
+
+# ----------------------------
+# SAVED ITEMS
+# ----------------------------
+
+# saved posts and comments, one row per (user, item). pages are read newest
+# first from the (user_id, id) index with the last save id as the cursor.
+
+TARGETS = {
+    db.SavedPost: "post_id",
+    db.SavedComment: "comment_id",
+}
+
+
+def save(model, user_id, target_id):
+    database.session.add(model(user_id=user_id, **{TARGETS[model]: target_id}))
+    try:
+        database.session.commit()
+    except IntegrityError:
+        # already saved
+        database.session.rollback()
+
+
+def unsave(model, user_id, target_id):
+    database.session.query(model).filter(
+        model.user_id == user_id,
+        getattr(model, TARGETS[model]) == target_id,
+    ).delete(synchronize_session=False)
+    database.session.commit()
+
+
+def page(model, user_id, before=None, limit=25):
+    # (target ids newest first, cursor for the next page or None)
+    target = getattr(model, TARGETS[model])
+    query = database.session.query(model.id, target).filter(model.user_id == user_id)
+    if before is not None:
+        query = query.filter(model.id < before)
+    rows = query.order_by(model.id.desc()).limit(limit + 1).all()
+    cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [r[1] for r in rows[:limit]], cursor
@@ -1,5 +1,5 @@
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
-from marshmallow import Schema, ValidationError, fields
+from marshmallow import Schema, ValidationError, fields, validate
 
 import db
 
@@ -13,6 +13,7 @@ class PostSchema(SQLAlchemyAutoSchema):
         model = db.Post
         load_instance = True
         include_relationships = True
+        exclude = ("excerpt",)
 
 
 class PostVoteSchema(SQLAlchemyAutoSchema):
@@ -27,6 +28,7 @@ class CommunitySchema(SQLAlchemyAutoSchema):
         model = db.Community
         load_instance = True
         include_relationships = True
+        exclude = ("shard",)
 
 
 class UserSchema(SQLAlchemyAutoSchema):
@@ -34,7 +36,7 @@ class UserSchema(SQLAlchemyAutoSchema):
         model = db.User
         load_instance = True
         include_relationships = True
-        exclude = ("password",)
+        exclude = ("password", "unread_notifs", "history_seq", "history_cleared_at")
 
 
 class CommentSchema(SQLAlchemyAutoSchema):
@@ -42,11 +44,24 @@ class CommentSchema(SQLAlchemyAutoSchema):
         model = db.Comment
         load_instance = True
         include_relationships = True
+        exclude = ("score",)
 
     # replies
     replies = fields.Nested("CommentSchema", many=True)
 
 
+class NotificationSchema(SQLAlchemyAutoSchema):
+    class Meta:
+        model = db.Notification
+        load_instance = True
+        include_relationships = True
+        exclude = ("post_id", "comment_id")
+
+    # the post and comment may be on another shard, only their ids
+    post = fields.Integer(attribute="post_id")
+    comment = fields.Integer(attribute="comment_id")
+
+
 class CommentVoteSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = db.CommentVote
@@ -119,6 +134,18 @@ class PasswordChangeSchema(Schema):
     old_password = fields.Str(required=True)
     new_password = fields.Str(required=True)
 
+class BatchSchema(Schema):
+    requests = fields.List(fields.Str(), required=True)
+
+class ReadNotificationsSchema(Schema):
+    up_to = fields.Int(required=False)
+
+class ProfileSchema(Schema):
+    seconds = fields.Float(required=False, validate=validate.Range(min=1, max=600))
+    sample = fields.Float(required=False, validate=validate.Range(min=0, max=1, min_inclusive=False))
+    route = fields.Str(required=False, allow_none=True)
+    interval_ms = fields.Float(required=False, validate=validate.Range(min=1, max=1000))
+
 login_schema = LoginSchema()
 register_schema = RegisterSchema()
 create_comment_schema = CreateCommentSchema()
@@ -130,3 +157,6 @@ update_comment_schema = UpdateCommentSchema()
 join_community_schema = JoinCommunitySchema()
 password_change_schema = PasswordChangeSchema()
 update_me_schema = UpdateMeSchema()
+batch_schema = BatchSchema()
+read_notifications_schema = ReadNotificationsSchema()
+profile_schema = ProfileSchema()
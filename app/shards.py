@@ -0,0 +1,196 @@
+import heapq
+from contextlib import contextmanager
+from itertools import islice
+
+from flask import current_app, request
+from sqlalchemy import ForeignKey, Index, MetaData, Table, text
+
+import db
+from db import database
+
+# ----------------------------
+# SHARDING
+# ----------------------------
+
+# posts, comments and their votes (db.SHARDED) are split by community over
+# the binds in app.config["SHARDS"]. shard 0 is the main database, where
+# users, communities and everything else stay. a community's shard is
+# communities.shard, picked when it is created and never changed.
+#
+# ids on shard k start at k << SHARD_BITS, so a post or comment id alone
+# says which shard it is on. requests are routed by the post_id, comment_id
+# or community_id in their url (init_app). other code picks a shard with
+# using(). reads that span communities run once per shard and are merged.
+
+SHARD_BITS = 40
+
+
+def count():
+    return len(current_app.config.get("SHARDS", [None]))
+
+
+def of_id(row_id):
+    # ids from a shard that doesn't exist can't match anything (nor can
+    # ids that aren't ints, validation rejects those later), send them to
+    # shard 0 to miss there
+    try:
+        shard = int(row_id) >> SHARD_BITS
+    except (TypeError, ValueError):
+        return 0
+    return shard if 0 <= shard < count() else 0
+
+
+# community id -> shard, the mapping never changes
+_communities = {}
+
+
+def of_community(community_id):
+    shard = _communities.get(community_id)
+    if shard is None:
+        shard = database.session.query(db.Community.shard).filter(
+            db.Community.id == community_id).scalar()
+        if shard is None:
+            return 0
+        _communities[community_id] = shard
+    return shard
+
+
+def of_communities(community_ids):
+    # the set of shards holding any of the communities
+    missing = [c for c in community_ids if c not in _communities]
+    if missing:
+        for cid, shard in database.session.query(db.Community.id, db.Community.shard).filter(
+                db.Community.id.in_(missing)).all():
+            _communities[cid] = shard or 0
+    return set(_communities.get(c, 0) for c in community_ids)
+
+
+def assign(community_id):
+    return community_id % count()
+
+
+@contextmanager
+def using(shard):
+    token = db.current.set(shard)
+    try:
+        yield shard
+    finally:
+        db.current.reset(token)
+
+
+def each(shards=None):
+    # for shard in each(): ... runs the loop body on every shard in turn
+    for shard in (range(count()) if shards is None else sorted(set(shards))):
+        with using(shard):
+            yield shard
+
+
+def gather(fn, shards=None):
+    return [fn() for _ in each(shards)]
+
+
+def merge(lists, key, limit=None, offset=0):
+    # each list sorted by key, descending
+    rows = heapq.merge(*lists, key=key, reverse=True)
+    return list(islice(rows, offset, None if limit is None else offset + limit))
+
+
+def top(make_query, key, limit, offset=0, shards=None):
+    # rows offset..offset + limit of make_query() across shards. make_query
+    # must order by the same thing as key, descending
+    if count() == 1:
+        return make_query().limit(limit).offset(offset).all()
+    lists = gather(lambda: make_query().limit(offset + limit).all(), shards)
+    return merge(lists, key, limit, offset)
+
+
+def by_shard(ids):
+    groups = {}
+    for i in ids:
+        groups.setdefault(of_id(i), []).append(i)
+    return groups
+
+
+class Scatter:
+    # a query streamed from every shard in turn, for stream.stream_list and
+    # stream_object
+    def __init__(self, query, shards=None):
+        self.query = query
+        self.shards = shards
+
+
+def joinable(a, b):
+    # whether two mapped classes' tables live in the same database
+    return count() == 1 or \
+        (a.__table__.name in db.SHARDED) == (b.__table__.name in db.SHARDED)
+
+
+def route(shard):
+    # the shard for the rest of this request, for handlers that find their
+    # post or community in the body rather than the url
+    request.environ["mosaic.shard"] = shard
+
+
+def init_app(app):
+    @app.before_request
+    def _route_shard():
+        args = request.view_args or {}
+        if "post_id" in args:
+            route(of_id(args["post_id"]))
+        elif "comment_id" in args:
+            route(of_id(args["comment_id"]))
+        elif "community_id" in args:
+            route(of_community(args["community_id"]))
+
+
+def create_all():
+    # development only, like database.create_all(): the sharded tables on
+    # every shard but 0, without the foreign keys into the main database
+    for shard, key in enumerate(current_app.config.get("SHARDS", [None])):
+        if shard == 0:
+            continue
+        engine = database.engines[key]
+        meta = MetaData()
+        for name in sorted(db.SHARDED):
+            _copy_table(database.metadata.tables[name], meta)
+        meta.create_all(engine)
+        seed_ids(engine, shard)
+
+
+def _copy_table(table, meta):
+    columns, keys = [], []
+    for column in table.c:
+        copy = column._copy()
+        copy.foreign_keys.clear()
+        copy.constraints = set()
+        columns.append(copy)
+        keys.append([ForeignKey(fk.target_fullname, ondelete=fk.ondelete)
+                     for fk in column.foreign_keys
+                     if fk.target_fullname.split(".")[0] in db.SHARDED])
+    copy = Table(table.name, meta, *columns, **table.kwargs)
+    for column, fks in zip(columns, keys):
+        for fk in fks:
+            column.append_foreign_key(fk)
+    # indexes declared in __table_args__, the column ones came with the columns
+    names = set(i.name for i in copy.indexes)
+    for index in table.indexes:
+        if index.name not in names:
+            Index(index.name, *[copy.c[c.name] for c in index.columns], unique=index.unique)
+
+
+def seed_ids(engine, shard):
+    # start the id counters of an empty shard at its range
+    base = shard << SHARD_BITS
+    with engine.begin() as conn:
+        for name in sorted(db.SHARDED):
+            if database.metadata.tables[name].autoincrement_column is None:
+                # ids copied from elsewhere, e.g. the archive tables
+                continue
+            if conn.execute(text(f"SELECT MAX(id) FROM {name}")).scalar() is not None:
+                continue
+            if engine.dialect.name == "sqlite":
+                conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :t"), {"t": name})
+                conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:t, :s)"),
+                             {"t": name, "s": base})
+            else:
+                conn.execute(text(f"ALTER TABLE {name} AUTO_INCREMENT = {base + 1}"))
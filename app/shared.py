@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from functools import wraps
+
+# ----------------------------
+# SHARED STORE
+# ----------------------------
+
+# small state shared by all worker processes on this machine, kept in a
+# sqlite file in WAL mode. each thread of each process opens its own
+# connection.
+#
+# sqlite3 blocks without yielding to gevent, a wait for the write lock
+# (up to the 1s timeout) would stall every greenlet in the worker. under a
+# monkey-patched gevent worker every call runs on gevent's threadpool, the
+# request's greenlet waits for it and the others keep running.
+
+
+def _threadpool():
+    if "gevent" in sys.modules:
+        from gevent import monkey
+        if monkey.is_module_patched("socket"):
+            import gevent
+            return gevent.get_hub().threadpool
+    return None
+
+
+def offloaded(f):
+    def call(args, kws):
+        # errors come back as values, the pool would print them
+        try:
+            return f(*args, **kws), None
+        except Exception as e:
+            return None, e
+
+    @wraps(f)
+    def decorated_function(*args, **kws):
+        pool = _threadpool()
+        if pool is None:
+            return f(*args, **kws)
+        result, error = pool.apply(call, (args, kws))
+        if error is not None:
+            raise error
+        return result
+    return decorated_function
+
+
+class SharedStore:
+    def __init__(self, path=None):
+        self.path = path
+        self.max_idempotency_keys = 100000
+        self._local = threading.local()
+        if path is not None:
+            self._setup()
+
+    def init_app(self, app):
+        self.path = app.config.get(
+            "SHARED_STORE_PATH", os.path.join(app.instance_path, "shared.db"))
+        self.max_idempotency_keys = app.config.get(
+            "IDEMPOTENCY_MAX_KEYS", self.max_idempotency_keys)
+        self._setup()
+
+    def _setup(self):
+        # created readable by this user only, sqlite gives the -wal and -shm
+        # files the same mode
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        c = self._conn()
+        c.execute("PRAGMA journal_mode=WAL")
+        c.execute("""CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT PRIMARY KEY, tokens REAL, updated REAL)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY, value TEXT, expires REAL)""")
+        # bumped by every delete, a cache loader only writes back its value
+        # if the key's generation is still the one it saw before loading
+        c.execute("""CREATE TABLE IF NOT EXISTS gens (
+            key TEXT PRIMARY KEY, gen INTEGER, updated REAL)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS peers (
+            port INTEGER PRIMARY KEY, pid INTEGER, updated REAL)""")
+        # status is NULL while the first request is still running
+        c.execute("""CREATE TABLE IF NOT EXISTS idempotency (
+            key TEXT PRIMARY KEY, fingerprint TEXT, status INTEGER,
+            content_type TEXT, body BLOB, created REAL, expires REAL)""")
+
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None or self._local.pid != os.getpid():
+            c = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            c.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = c
+            self._local.pid = os.getpid()
+        return c
+
+    @offloaded
+    def take_token(self, key, rate, burst, cost=1):
+        # token bucket refilled at `rate` tokens per second up to `burst`.
+        # returns (allowed, seconds until enough tokens are available)
+        c = self._conn()
+        now = time.time()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = burst if row is None else min(
+                burst, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            c.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                      (key, tokens, now))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    @offloaded
+    def get(self, key):
+        row = self._conn().execute(
+            "SELECT value FROM kv WHERE key = ? AND expires > ?",
+            (key, time.time())).fetchone()
+        return None if row is None else row[0]
+
+    @offloaded
+    def set(self, key, value, ttl):
+        self._conn().execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                             (key, value, time.time() + ttl))
+
+    @offloaded
+    def delete(self, *keys):
+        c = self._conn()
+        now = time.time()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany("DELETE FROM kv WHERE key = ?", [(k,) for k in keys])
+            c.executemany(
+                "INSERT INTO gens VALUES (?, 1, ?) ON CONFLICT (key) "
+                "DO UPDATE SET gen = gen + 1, updated = excluded.updated",
+                [(k, now) for k in keys])
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+    @offloaded
+    def generation(self, key):
+        row = self._conn().execute(
+            "SELECT gen FROM gens WHERE key = ?", (key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    @offloaded
+    def set_if(self, key, value, ttl, gen):
+        # set() unless key was deleted since generation(key) returned gen.
+        # returns whether it was set
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute("SELECT gen FROM gens WHERE key = ?", (key,)).fetchone()
+            ok = (0 if row is None else row[0]) == gen
+            if ok:
+                c.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                          (key, value, time.time() + ttl))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return ok
+
+    @offloaded
+    def claim(self, key, fingerprint, ttl):
+        # the live row for key as (fingerprint, status, content_type, body),
+        # or None after inserting a pending row owned by the caller
+        c = self._conn()
+        now = time.time()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            row = c.execute(
+                "SELECT fingerprint, status, content_type, body FROM idempotency "
+                "WHERE key = ? AND expires > ?", (key, now)).fetchone()
+            if row is None:
+                c.execute(
+                    "INSERT OR REPLACE INTO idempotency VALUES (?, ?, NULL, NULL, NULL, ?, ?)",
+                    (key, fingerprint, now, now + ttl))
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return row
+
+    @offloaded
+    def finish(self, key, status, content_type, body, ttl):
+        self._conn().execute(
+            "UPDATE idempotency SET status = ?, content_type = ?, body = ?, expires = ? "
+            "WHERE key = ?", (status, content_type, body, time.time() + ttl, key))
+
+    @offloaded
+    def release(self, key):
+        self._conn().execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    @offloaded
+    def register_peer(self, port):
+        self._conn().execute("INSERT OR REPLACE INTO peers VALUES (?, ?, ?)",
+                             (port, os.getpid(), time.time()))
+
+    @offloaded
+    def peers(self, max_age=30):
+        rows = self._conn().execute(
+            "SELECT port FROM peers WHERE updated > ?", (time.time() - max_age,))
+        return [r[0] for r in rows]
+
+    @offloaded
+    def purge_buckets(self, idle=3600):
+        self._purge_buckets(idle)
+
+    def _purge_buckets(self, idle):
+        self._conn().execute(
+            "DELETE FROM buckets WHERE updated < ?", (time.time() - idle,))
+
+    @offloaded
+    def purge(self, idle=3600):
+        self._purge_buckets(idle)
+        now = time.time()
+        c = self._conn()
+        c.execute("DELETE FROM kv WHERE expires < ?", (now,))
+        c.execute("DELETE FROM idempotency WHERE expires < ?", (now,))
+        # keep the newest keys if clients send more than the table should hold
+        c.execute("""DELETE FROM idempotency WHERE key IN (
+            SELECT key FROM idempotency ORDER BY created DESC LIMIT -1 OFFSET ?)""",
+                  (self.max_idempotency_keys,))
+        c.execute("DELETE FROM peers WHERE updated < ?", (now - 60,))
+        # no load runs for this long, a generation starting over is harmless
+        c.execute("DELETE FROM gens WHERE updated < ?", (now - idle,))
@@ -0,0 +1,178 @@
+import json
+
+from flask import Response, request, stream_with_context
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+import shards
+from db import database
+
+# ----------------------------
+# STREAMING JSON
+# ----------------------------
+
+# large list responses are encoded row by row from a server-side cursor
+# (yield_per) instead of being built in memory by jsonify. clients sending
+# Accept: application/x-ndjson get one json document per line instead.
+
+BATCH = 200
+CHUNK = 16 * 1024
+
+
+def _dumps(item):
+    return json.dumps(item, separators=(",", ":"), sort_keys=True)
+
+
+def _rows(query, dump, related, keep=None):
+    if callable(query):
+        # a function yielding the rows, for parts read from several queries
+        for obj in query():
+            if keep is None or keep(obj):
+                yield dump(obj)
+        return
+    if isinstance(query, shards.Scatter):
+        for _ in shards.each(query.shards):
+            yield from _rows(query.query, dump, related, keep)
+        return
+    # the view's session was already removed when its app context was torn
+    # down, reading on it would hold a connection nothing gives back
+    query = _rebound(query)
+    if related:
+        # many-to-one relationships are joined in up front, a lazy load would
+        # need a second query on the connection the cursor is still reading.
+        # ones in another database (sharded posts -> users) are loaded per
+        # batch instead, on that database's own connection
+        model = query.column_descriptions[0]["entity"]
+        query = query.options(*[
+            (joinedload if shards.joinable(model, r.mapper.class_) else selectinload)(
+                getattr(model, r.key))
+            for r in inspect(model).relationships if r.direction is MANYTOONE])
+    for obj in query.yield_per(BATCH):
+        if keep is None or keep(obj):
+            yield dump(obj)
+
+
+def _buffered(parts):
+    buf = []
+    size = 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= CHUNK:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+
+def _rebound(query):
+    # the query on the session of the app context running it, a pool thread
+    # or the one stream_with_context pushed again
+    return query.with_session(database.session())
+
+
+def _sources(parts, keys, prefetch):
+    # the first part is read here, the others start on the parallel pool
+    # right away when the caller passed its prefetch
+    items = {keys[0]: _rows(*parts[keys[0]])} if keys else {}
+    for key in keys[1:]:
+        items[key] = prefetch(lambda part=parts[key]: _rows(*part)) \
+            if prefetch is not None else _rows(*parts[key])
+    return items
+
+
+def _json_array(items):
+    yield "["
+    first = True
+    for item in items:
+        yield ("" if first else ",") + _dumps(item)
+        first = False
+    yield "]"
+
+
+def _close(items):
+    # stops the prefetches of parts not sent yet when the response is closed
+    # early, see parallel.Prefetched
+    for source in items.values():
+        close = getattr(source, "close", None)
+        if close is not None:
+            close()
+
+
+def _json_object(parts, prefetch=None):
+    keys = sorted(parts)
+    items = _sources(parts, keys, prefetch)
+    try:
+        yield "{"
+        for i, key in enumerate(keys):
+            yield ("," if i else "") + _dumps(key) + ":"
+            yield from _json_array(items[key])
+        yield "}"
+    finally:
+        _close(items)
+
+
+def _ndjson(parts, prefetch=None):
+    keys = list(parts)
+    items = _sources(parts, keys, prefetch)
+    try:
+        for key in keys:
+            for item in items[key]:
+                yield _dumps({"type": key, "item": item} if key else item) + "\n"
+    finally:
+        _close(items)
+
+
+def negotiated():
+    # the format the client asked for, None when it accepts neither
+    return request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"])
+
+
+def wants_ndjson():
+    return negotiated() == "application/x-ndjson"
+
+
+def _vary(resp):
+    # the body depends on Accept, shared caches must key on it
+    resp.vary.add("Accept")
+    return resp
+
+
+def stream_list(query, dump, related=True, keep=None):
+    # same body as jsonify([dump(x) for x in query.all()]). pass
+    # related=False when dump doesn't touch relationships, rows for which
+    # keep(row) is false are skipped
+    part = (query, dump, related, keep)
+    if wants_ndjson():
+        gen, mimetype = _ndjson({None: part}), "application/x-ndjson"
+    else:
+        gen, mimetype = _json_array(_rows(*part)), "application/json"
+    return _vary(Response(stream_with_context(_buffered(gen)), mimetype=mimetype))
+
+
+def send_list(items):
+    # stream_list's body for items already dumped, e.g. read from the cache
+    if wants_ndjson():
+        return _vary(Response("".join(_dumps(item) + "\n" for item in items),
+                              mimetype="application/x-ndjson"))
+    return _vary(Response("".join(_json_array(items)), mimetype="application/json"))
+
+
+def stream_object(parts, prefetch=None):
+    # parts is {key: (query, dump, related[, keep])}, same body as
+    # jsonify({key: [dump(x) for x in query.all()], ...}). with prefetch
+    # (parallel.Pool.prefetch) the parts after the first are queried at the
+    # same time as the first instead of after it
+    if wants_ndjson():
+        return _vary(stream_ndjson(parts, prefetch=prefetch))
+    return _vary(Response(stream_with_context(_buffered(_json_object(parts, prefetch))),
+                          mimetype="application/json"))
+
+
+def stream_ndjson(parts, headers=None, prefetch=None):
+    # one {"type": key, "item": ...} line per row, parts in order
+    return Response(stream_with_context(_buffered(_ndjson(parts, prefetch))),
+                    mimetype="application/x-ndjson", headers=headers)
@@ -0,0 +1,96 @@
+from array import array
+from bisect import bisect_left, insort
+
+import db
+from cache import LRU, Generations
+from db import database
+
+# ----------------------------
+# SUBSCRIPTIONS
+# ----------------------------
+
+# the communities each recently active user is subscribed to, as a sorted
+# array of ids in every worker, so membership checks are a bisect instead of
+# a query. join/leave patch the local copy and drop it in the other workers
+# through the cache invalidation bus. arrays are replaced, never changed in
+# place, so readers never see one half updated. a load that raced a change
+# isn't kept, see Generations in cache.py.
+
+PREFIX = "subs:"
+
+
+def _find(ids, community_id):
+    i = bisect_left(ids, community_id)
+    return i < len(ids) and ids[i] == community_id
+
+
+class SubscriptionCache:
+    def __init__(self, bus=None, app=None, size=20000, ttl=600):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = LRU(size)
+        self._gens = Generations(size)
+        self.bus = bus
+        if bus is not None:
+            bus.subscribe(self._on_bus)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config.get("SUBSCRIPTIONS_TTL", self.ttl)
+
+    def get(self, user_id):
+        ids = self._local.get(user_id)
+        if ids is not None:
+            self.hits += 1
+            return ids
+        self.misses += 1
+        start = self._gens.start()
+        rows = database.session.query(db.SubscribedCommunity.community_id).filter(
+            db.SubscribedCommunity.user_id == user_id).distinct().all()
+        ids = array("q", sorted(r[0] for r in rows))
+        if not self._gens.changed(user_id, start):
+            self._local.set(user_id, ids, self.ttl)
+            if self._gens.changed(user_id, start):
+                self._local.delete(user_id)
+        return ids
+
+    def contains(self, user_id, community_id):
+        return _find(self.get(user_id), community_id)
+
+    def add(self, user_id, community_id):
+        # call after the insert is committed
+        self._gens.bump(user_id)
+        ids = self._local.get(user_id)
+        if ids is not None and not _find(ids, community_id):
+            ids = array("q", ids)
+            insort(ids, community_id)
+            self._local.set(user_id, ids, self.ttl)
+        self._publish(user_id)
+
+    def remove(self, user_id, community_id):
+        self._gens.bump(user_id)
+        ids = self._local.get(user_id)
+        if ids is not None and _find(ids, community_id):
+            ids = array("q", ids)
+            ids.pop(bisect_left(ids, community_id))
+            self._local.set(user_id, ids, self.ttl)
+        self._publish(user_id)
+
+    def to_dict(self):
+        return {
+            "users": len(self._local),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _publish(self, user_id):
+        if self.bus is not None:
+            self.bus.publish([f"{PREFIX}{user_id}"])
+
+    def _on_bus(self, keys):
+        for key in keys:
+            if key.startswith(PREFIX):
+                self._gens.bump(int(key[len(PREFIX):]))
+                self._local.delete(int(key[len(PREFIX):]))
@@ -0,0 +1,235 @@
+import json
+import zlib
+from datetime import datetime
+
+from marshmallow import ValidationError
+
+import archive
+import db
+from db import database
+import karma
+import schema
+
+# ----------------------------
+# COMMUNITY EXPORT / IMPORT
+# ----------------------------
+
+# the export is ndjson: one community line, then posts, then comments
+# ordered by id so parents always come before their replies. archived posts
+# and their comments are decoded from their documents and exported first,
+# in the same format. every line is {"type": ..., "item": ...}. the import
+# reads the same format and inserts in batches, mapping exported ids to the
+# new ones, so archived posts come back as live ones.
+
+IMPORT_BATCH = 500
+BATCH = 200
+
+POST_COLUMNS = ("id", "title", "content", "display_pic", "upvotes",
+                "downvotes", "time_created", "user_id")
+COMMENT_COLUMNS = ("id", "post_id", "parent_comment", "content", "upvotes",
+                   "downvotes", "time_created", "user_id")
+
+
+def _columns(columns):
+    def dump(obj):
+        d = {}
+        for c in columns:
+            v = getattr(obj, c)
+            d[c] = v.isoformat() if isinstance(v, datetime) else v
+        return d
+    return dump
+
+
+def _archived(community_id):
+    # the decoded documents of the community's archived posts, by id
+    rows = database.session.query(db.ArchivedPost.data).filter_by(
+        community_id=community_id).order_by(db.ArchivedPost.id)
+    for (data,) in rows.yield_per(BATCH):
+        yield json.loads(zlib.decompress(data))
+
+
+def _archived_post(dumped):
+    # a PostSchema dump in the export's columns
+    return dict({c: dumped.get(c) for c in POST_COLUMNS}, user_id=dumped.get("user"))
+
+
+def _archived_comment(dumped):
+    return dict({c: dumped.get(c) for c in COMMENT_COLUMNS}, post_id=dumped.get("post"),
+                parent_comment=dumped.get(archive.PARENT), user_id=dumped.get("user"))
+
+
+def _posts(community_id):
+    for doc in _archived(community_id):
+        yield _archived_post(doc["post"])
+    dump = _columns(POST_COLUMNS)
+    posts = database.session.query(db.Post).filter_by(
+        community_id=community_id).order_by(db.Post.id)
+    for post in posts.yield_per(BATCH):
+        yield dump(post)
+
+
+def _comments(community_id):
+    for doc in _archived(community_id):
+        for comment in doc["comments"]:
+            yield _archived_comment(comment)
+    dump = _columns(COMMENT_COLUMNS)
+    comments = database.session.query(db.Comment).join(
+        db.Post, db.Comment.post_id == db.Post.id).filter(
+        db.Post.community_id == community_id).order_by(db.Comment.id)
+    for comment in comments.yield_per(BATCH):
+        yield dump(comment)
+
+
+def export_parts(community_id):
+    # parts for stream.stream_ndjson. posts and comments are functions
+    # yielding rows already dumped, live and archived
+    community = database.session.query(db.Community).filter_by(id=community_id)
+    return {
+        "community": (community, schema.CommunitySchema().dump, True),
+        "post": (lambda: _posts(community_id), _same, False),
+        "comment": (lambda: _comments(community_id), _same, False),
+    }
+
+
+def _same(item):
+    return item
+
+
+class TransferError(Exception):
+    def __init__(self, line, message):
+        super().__init__(message)
+        self.line = line
+        self.message = message
+
+
+class Importer:
+    def __init__(self, community_id, user_id):
+        self.community_id = community_id
+        self.user_id = user_id
+        # exported id -> new id
+        self.posts = {}
+        self.comments = {}
+        self.pending = []
+        self.pending_ids = set()
+        self.imported = {"post": 0, "comment": 0}
+
+    def run(self, lines):
+        for n, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                kind, item = record["type"], record["item"]
+            except (ValueError, KeyError, TypeError):
+                raise TransferError(n, "Bad line")
+            if kind == "post":
+                self._post(n, item)
+            elif kind == "comment":
+                self._comment(n, item)
+            elif kind != "community":
+                raise TransferError(n, f"Unknown type {kind}")
+            if len(self.pending) >= IMPORT_BATCH:
+                self.flush()
+        self.flush()
+        return self.imported
+
+    def _known(self, kind, old_id):
+        return old_id in (self.posts if kind == "post" else self.comments) \
+            or (kind, old_id) in self.pending_ids
+
+    def _add(self, kind, item, obj, refs=None):
+        created = _time(item.get("time_created"))
+        if created is not None:
+            obj.time_created = created
+        self.pending.append((kind, item.get("id"), obj, refs))
+        self.pending_ids.add((kind, item.get("id")))
+
+    def _post(self, n, item):
+        b = {"title": item.get("title"), "content": item.get("content"),
+             "community_id": self.community_id}
+        if item.get("display_pic"):
+            b["display_pic"] = item["display_pic"]
+        try:
+            schema.create_post_schema.load(b)
+        except ValidationError as err:
+            raise TransferError(n, err.messages)
+        if b["title"].strip() == "":
+            raise TransferError(n, "Title cannot be empty")
+        self._add("post", item, db.Post(
+            title=b["title"].strip(), content=b["content"],
+            display_pic=b.get("display_pic"), community_id=self.community_id,
+            user_id=item.get("user_id")))
+
+    def _comment(self, n, item):
+        b = {"content": item.get("content"), "post": item.get("post_id")}
+        if item.get("parent_comment") is not None:
+            b["parent"] = item["parent_comment"]
+        try:
+            schema.create_comment_schema.load(b)
+        except ValidationError as err:
+            raise TransferError(n, err.messages)
+        if not self._known("post", b["post"]):
+            raise TransferError(n, "Comment on a post that is not in the import")
+        if "parent" in b and not self._known("comment", b["parent"]):
+            raise TransferError(n, "Reply to a comment that is not in the import")
+        # post_id and parent_comment are resolved at flush time, they may
+        # still be pending in this batch
+        self._add("comment", item, db.Comment(
+            content=b["content"], user_id=item.get("user_id")),
+            (b["post"], b.get("parent")))
+
+    def flush(self):
+        if not self.pending:
+            return
+        self._resolve_users()
+        # all posts in one flush, then comments in as few flushes as the
+        # reply chains inside the batch allow
+        posts = [(old, obj) for kind, old, obj, _ in self.pending if kind == "post"]
+        self._insert(posts, self.posts)
+        batch = []
+        for kind, old, obj, refs in self.pending:
+            if kind != "comment":
+                continue
+            post, parent = refs
+            if parent is not None and parent not in self.comments:
+                self._insert(batch, self.comments)
+                batch = []
+            obj.post_id = self.posts[post]
+            obj.parent_comment = self.comments[parent] if parent is not None else None
+            batch.append((old, obj))
+        self._insert(batch, self.comments)
+        counts = {}
+        for kind, _, obj, _ in self.pending:
+            counts.setdefault(obj.user_id, {"post_count": 0, "comment_count": 0})[kind + "_count"] += 1
+        for user_id, deltas in counts.items():
+            karma.bump(user_id, **deltas)
+        database.session.commit()
+        self.imported["post"] += len(posts)
+        self.imported["comment"] += sum(1 for p in self.pending if p[0] == "comment")
+        self.pending = []
+        self.pending_ids = set()
+
+    def _insert(self, rows, ids):
+        if not rows:
+            return
+        database.session.add_all([obj for _, obj in rows])
+        database.session.flush()
+        for old, obj in rows:
+            ids[old] = obj.id
+
+    def _resolve_users(self):
+        # keep the original author when they exist here, else the importer
+        wanted = set(p[2].user_id for p in self.pending if p[2].user_id is not None)
+        existing = set(x[0] for x in database.session.query(db.User.id).filter(
+            db.User.id.in_(wanted)).all()) if wanted else set()
+        for p in self.pending:
+            if p[2].user_id not in existing:
+                p[2].user_id = self.user_id
+
+
+def _time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
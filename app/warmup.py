@@ -0,0 +1,178 @@
+import json
+import mmap
+import os
+import random
+import struct
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+# ----------------------------
+# WARM START
+# ----------------------------
+
+# each worker writes its hottest cache entries to WARM_DIR/<pid>.snap when
+# it exits. the gunicorn master reads the snapshots back in when_ready,
+# before any worker is forked or any request accepted, and puts up to
+# WARM_KEYS entries into the cache, so every worker starts with them in its
+# LRU (shared copy-on-write after gc.freeze) and the shared tier has them
+# too. snapshots older than WARM_MAX_AGE seconds are ignored, the data
+# behind them has had too long to change. without a usable snapshot the
+# functions registered with @warmup.prefetch load the top WARM_PREFETCH
+# posts, communities and lists from the database instead.
+#
+# warmed entries expire at random points between half of WARM_TTL and all of
+# it, in both levels, so the cold reads after a deploy come back spread over
+# minutes and not all at once. writes after the master loads them invalidate
+# them like any entry. writes between the snapshot and the load don't,
+# WARM_TTL bounds how long an entry changed then is served.
+#
+#   MAGIC, then per entry, hottest first:
+#   <H key length> <I value length> key (utf-8) value (compact json)
+
+MAGIC = b"MOSAICW1"
+RECORD = struct.Struct("<HI")
+
+
+class Warmup:
+    def __init__(self, cache, app=None, directory="mosaic-warm",
+                 keys=2000, max_age=600, prefetch=200, ttl=300):
+        self.cache = cache
+        self.directory = directory
+        self.keys = keys
+        self.max_age = max_age
+        self.limit = prefetch
+        self.ttl = ttl
+        self.source = None
+        self.loaded = 0
+        self.seconds = 0.0
+        self.saved = 0
+        self._prefetchers = []
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.directory = app.config.get("WARM_DIR", self.directory)
+        self.keys = app.config.get("WARM_KEYS", self.keys)
+        self.max_age = app.config.get("WARM_MAX_AGE", self.max_age)
+        self.limit = app.config.get("WARM_PREFETCH", self.limit)
+        self.ttl = app.config.get("WARM_TTL", self.ttl)
+
+    def prefetch(self, f):
+        # f(limit) returns [(key, value)] to cache when there is no snapshot
+        self._prefetchers.append(f)
+        return f
+
+    def save(self):
+        # called in a worker as it exits
+        entries = self.cache.local.items()[:self.keys]
+        try:
+            # cached users and their emails, readable by this user only
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.snap")
+            fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "wb") as f:
+                f.write(MAGIC)
+                for key, value in entries:
+                    k = key.encode("utf-8")
+                    v = json.dumps(value, separators=(",", ":")).encode("utf-8")
+                    f.write(RECORD.pack(len(k), len(v)))
+                    f.write(k)
+                    f.write(v)
+            os.replace(path + ".tmp", path)
+            self.saved = len(entries)
+        except (OSError, TypeError, ValueError, struct.error):
+            pass
+
+    def load(self):
+        # called once in the master, before the workers are forked
+        start = time.monotonic()
+        entries = self._snapshots()
+        self.source = "snapshot" if entries else None
+        if not entries and self._prefetchers:
+            entries = self._prefetched()
+            self.source = "prefetch" if entries else None
+        # coldest first, the hottest end up most recently used in the LRU
+        for key, value in reversed(entries):
+            ttl = self.ttl * random.uniform(0.5, 1)
+            self.cache.set(key, value, ttl=ttl, local_ttl=ttl)
+        self.loaded = len(entries)
+        self.seconds = round(time.monotonic() - start, 3)
+
+    def _snapshots(self):
+        # every worker's snapshot merged by rank, the hottest entry of each
+        # file first, then the second of each... a key seen twice keeps the
+        # value from the newest file. files are removed once read
+        try:
+            paths = [os.path.join(self.directory, n) for n in os.listdir(self.directory)
+                     if n.endswith(".snap")]
+        except OSError:
+            return []
+        now = time.time()
+        files = []
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+                if now - mtime <= self.max_age:
+                    files.append((mtime, _read(path)))
+            except (OSError, ValueError):
+                pass
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        files.sort(key=lambda f: -f[0])
+        ranked = {}
+        for _, records in files:
+            for rank, (key, value) in enumerate(records):
+                if key not in ranked:
+                    ranked[key] = (rank, value)
+                elif rank < ranked[key][0]:
+                    ranked[key] = (rank, ranked[key][1])
+        entries = sorted(ranked.items(), key=lambda kv: kv[1][0])[:self.keys]
+        return [(key, value) for key, (_, value) in entries]
+
+    def _prefetched(self):
+        entries = []
+        with self.app.app_context():
+            for f in self._prefetchers:
+                try:
+                    entries.extend(f(self.limit))
+                except SQLAlchemyError:
+                    pass
+        return entries[:self.keys]
+
+    def to_dict(self):
+        return {
+            "directory": self.directory,
+            "source": self.source,
+            "loaded": self.loaded,
+            "seconds": self.seconds,
+            "saved": self.saved,
+        }
+
+
+def _read(path):
+    # [(key, value)] in file order. the file is mapped, not read into a
+    # buffer, only the records are copied out
+    records = []
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return records
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a warm start snapshot")
+            pos = len(MAGIC)
+            while pos + RECORD.size <= len(m):
+                klen, vlen = RECORD.unpack_from(m, pos)
+                pos += RECORD.size
+                if pos + klen + vlen > len(m):
+                    # cut short, keep what came before
+                    break
+                key = m[pos:pos + klen].decode("utf-8")
+                value = json.loads(m[pos + klen:pos + klen + vlen])
+                pos += klen + vlen
+                records.append((key, value))
+    return records
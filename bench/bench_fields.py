@@ -0,0 +1,77 @@
+# compares a full PostSchema dump of a list page with a ?fields= projection
+#
+#   python bench/bench_fields.py [rows] [content_bytes]
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from flask import Flask
+
+import db
+from db import database
+import projection
+import schema
+
+CARD_FIELDS = ["id", "title", "excerpt", "upvotes", "downvotes", "time_created", "community"]
+
+
+def setup(rows, content_bytes):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    database.init_app(app)
+    ctx = app.app_context()
+    ctx.push()
+    database.create_all()
+    user = db.User(username="bench", password="x")
+    database.session.add(user)
+    database.session.flush()
+    community = db.Community(name="bench", description="bench",
+                             admin_id=user.id, created_by_id=user.id)
+    database.session.add(community)
+    database.session.flush()
+    body = "lorem ipsum " * (content_bytes // 12)
+    database.session.add_all([
+        db.Post(title=f"post {i}", content=body, user_id=user.id,
+                community_id=community.id, upvotes=i, downvotes=0)
+        for i in range(rows)
+    ])
+    database.session.commit()
+    return ctx
+
+
+def full():
+    posts = database.session.query(db.Post).order_by(db.Post.id.desc()).limit(20).all()
+    return json.dumps(schema.PostSchema(many=True).dump(posts))
+
+
+def projected():
+    posts = database.session.query(db.Post).options(
+        *projection.post_options(CARD_FIELDS)).order_by(db.Post.id.desc()).limit(20).all()
+    return json.dumps(projection.dump(posts, CARD_FIELDS))
+
+
+def measure(fn, n=200):
+    best = None
+    for _ in range(n):
+        database.session.expire_all()
+        start = time.perf_counter()
+        body = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(body), best
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    content_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    setup(rows, content_bytes)
+    full_bytes, full_time = measure(full)
+    proj_bytes, proj_time = measure(projected)
+    print(f"full      {full_bytes:>10} bytes  {full_time * 1000:8.2f} ms")
+    print(f"projected {proj_bytes:>10} bytes  {proj_time * 1000:8.2f} ms")
+    print(f"bytes -{100 - proj_bytes * 100 / full_bytes:.1f}%  "
+          f"time -{100 - proj_time * 100 / full_time:.1f}%")
@@ -0,0 +1,86 @@
+# latency of the endpoints whose queries run on the parallel pool, with the
+# pool off (PARALLEL_WORKERS=0) and on. each statement sleeps `latency_ms`
+# first to stand in for the round trip to a database server
+#
+#   python bench/bench_parallel.py [rows] [latency_ms] [workers]
+
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+DB_PATH = os.path.join(tempfile.gettempdir(), "mosaic-bench-parallel.db")
+os.environ.update(DBUSER="bench", DBPASS="bench", SECRET="bench", JOBS_ENABLED="0",
+                  SHARED_STORE_PATH=os.path.join(tempfile.gettempdir(), "mosaic-bench-shared.db"))
+
+from sqlalchemy import event
+
+import app as mosaic
+import db
+from db import database
+
+PATHS = [
+    "/search?q=user1",
+    "/search-posts?q=post+1&fields=id,title",
+    "/cm/{comment}/parent",
+    "/c/1/posts/3",
+    "/u/1/posts/3",
+    "/u/1/comments/3",
+]
+
+
+def setup(rows):
+    if os.path.exists(DB_PATH):
+        os.remove(DB_PATH)
+    mosaic.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + DB_PATH
+    app = mosaic.create_app(start_jobs=False)
+    with app.app_context():
+        database.create_all()
+        database.session.add_all(db.User(username=f"user{i}", password="x") for i in range(rows))
+        database.session.add_all(db.Community(name=f"community{i}", description="bench",
+                                              admin_id=1, created_by_id=1) for i in range(rows))
+        database.session.flush()
+        database.session.add_all(db.Post(title=f"post {i}", content="lorem ipsum " * 50,
+                                         user_id=1, community_id=1) for i in range(rows))
+        database.session.flush()
+        database.session.add_all(db.Comment(content=f"comment {i}", user_id=1, post_id=1,
+                                            parent_comment=i or None) for i in range(rows))
+        database.session.commit()
+    return app
+
+
+def measure(client, path, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        resp = client.get(path)
+        resp.get_data()
+        times.append(time.perf_counter() - start)
+        assert resp.status_code == 200, (path, resp.status_code)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    app = setup(rows)
+    with app.app_context():
+        event.listen(database.engine, "before_cursor_execute",
+                     lambda *args: time.sleep(latency))
+    client = app.test_client()
+    print(f"{rows} rows, {latency * 1000:.1f} ms per statement, {workers} pool threads")
+    print(f"{'path':42} {'sequential':>11} {'parallel':>11}")
+    for path in PATHS:
+        path = path.format(comment=rows // 2)
+        mosaic.pool.workers = 0
+        measure(client, path, 3)
+        before = measure(client, path, 20)
+        mosaic.pool.workers = workers
+        measure(client, path, 3)
+        after = measure(client, path, 20)
+        print(f"{path:42} {before * 1000:8.2f} ms {after * 1000:8.2f} ms"
+              f"  {100 - after * 100 / before:+.0f}%")
@@ -0,0 +1,73 @@
+# cold import time of app.py and private memory per forked worker, with and
+# without gc.freeze() in the parent
+#
+#   python bench/bench_startup.py [workers]
+
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+ENV = dict(os.environ, DBUSER="bench", DBPASS="bench", SECRET="bench",
+           JOBS_ENABLED="0", SHARED_STORE_PATH="/tmp/mosaic-bench-shared.db")
+
+IMPORT_TIME = """
+import sys, time
+sys.path.insert(0, {app_dir!r})
+start = time.perf_counter()
+{stmt}
+print(time.perf_counter() - start)
+"""
+
+FORK = """
+import gc, os, sys
+sys.path.insert(0, {app_dir!r})
+import app
+app.create_app(start_jobs=False)
+gc.collect()
+if {freeze}:
+    gc.freeze()
+pids = []
+for _ in range({workers}):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        # a worker's first full collections walk every tracked object
+        gc.collect()
+        gc.collect()
+        with open("/proc/self/smaps_rollup") as f:
+            private = sum(int(l.split()[1]) for l in f
+                          if l.startswith(("Private_Dirty", "Private_Clean")))
+        os.write(w, str(private).encode())
+        os._exit(0)
+    os.close(w)
+    pids.append((pid, r))
+total = 0
+for pid, r in pids:
+    total += int(os.read(r, 64))
+    os.waitpid(pid, 0)
+print(total / len(pids))
+"""
+
+
+def run(code):
+    out = subprocess.run([sys.executable, "-c", code], env=ENV, cwd=APP_DIR,
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def best_import(stmt, n=5):
+    return min(run(IMPORT_TIME.format(app_dir=APP_DIR, stmt=stmt)) for _ in range(n))
+
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    app_time = best_import("import app")
+    pil_time = best_import("import PIL.Image")
+    print(f"import app          {app_time * 1000:8.1f} ms")
+    print(f"import PIL.Image    {pil_time * 1000:8.1f} ms  (now deferred to first upload)")
+    plain = run(FORK.format(app_dir=APP_DIR, freeze=False, workers=workers))
+    frozen = run(FORK.format(app_dir=APP_DIR, freeze=True, workers=workers))
+    print(f"private kB/worker   {plain:8.0f} without gc.freeze")
+    print(f"private kB/worker   {frozen:8.0f} with gc.freeze")
@@ -0,0 +1,89 @@
+# size and lookup speed of the vote table: the old layout (surrogate id,
+# no index on the columns the handlers look up), the old layout with that
+# index added, and db.Vote
+#
+#   python bench/bench_votes.py [votes] [lookups]
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, MetaData, Table, create_engine
+from sqlalchemy.sql import func
+
+import db
+
+OLD = Table(
+    "votes", MetaData(),
+    Column("id", Integer, primary_key=True, index=True),
+    Column("post_id", Integer, nullable=False),
+    Column("time", DateTime, server_default=func.now()),
+    Column("user_id", Integer, nullable=False),
+    Column("upvote", Boolean),
+    sqlite_autoincrement=True,
+)
+
+# the old layout with only the missing index added
+OLD_INDEXED = OLD.to_metadata(MetaData())
+Index("ix_votes_user_id_post_id", OLD_INDEXED.c.user_id, OLD_INDEXED.c.post_id)
+
+QUERIES = {
+    # the vote handlers and GET /p/<id>/vote
+    "point": "SELECT upvote FROM votes WHERE user_id = ? AND post_id = ?",
+    # everything a user voted on
+    "user": "SELECT post_id, upvote FROM votes WHERE user_id = ?",
+}
+
+
+def build(table, votes, users, posts):
+    path = os.path.join(tempfile.gettempdir(), f"mosaic-bench-votes-{id(table)}.db")
+    if os.path.exists(path):
+        os.remove(path)
+    engine = create_engine("sqlite:///" + path)
+    # the table alone, without the tables its foreign keys point at
+    table.create(engine)
+    engine.dispose()
+    conn = sqlite3.connect(path)
+    rng = random.Random(1)
+    pairs = set()
+    while len(pairs) < votes:
+        pairs.add((rng.randrange(posts), rng.randrange(users)))
+    conn.executemany("INSERT INTO votes (post_id, user_id, upvote, time) VALUES (?, ?, ?, ?)",
+                     ((p, u, rng.random() < 0.8, "2024-01-01 00:00:00") for p, u in sorted(pairs)))
+    conn.commit()
+    conn.execute("VACUUM")
+    return conn, sorted(pairs)
+
+
+def size(conn):
+    # table and index pages
+    return conn.execute(
+        "SELECT SUM(pgsize) FROM dbstat WHERE name != 'sqlite_schema'").fetchone()[0]
+
+
+def measure(conn, sql, args):
+    start = time.perf_counter()
+    for a in args:
+        conn.execute(sql, a).fetchall()
+    return (time.perf_counter() - start) / len(args)
+
+
+if __name__ == "__main__":
+    votes = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    users, posts = max(votes // 50, 1), max(votes // 20, 1)
+    print(f"{votes} votes, {users} users, {posts} posts, {lookups} lookups")
+    print(f"{'':8} {'bytes':>12} {'point':>12} {'per user':>12}")
+    for name, table in (("old", OLD), ("old+idx", OLD_INDEXED), ("compact", db.Vote.__table__)):
+        conn, pairs = build(table, votes, users, posts)
+        rng = random.Random(2)
+        sample = [pairs[rng.randrange(len(pairs))] for _ in range(lookups)]
+        point = measure(conn, QUERIES["point"], [(u, p) for p, u in sample])
+        user = measure(conn, QUERIES["user"], [(u,) for _, u in sample])
+        print(f"{name:8} {size(conn):12} {point * 1e6:9.1f} us {user * 1e6:9.1f} us")
+        conn.close()
@@ -0,0 +1,156 @@
+# plays back a capture written by app/recorder.py (RECORD_PATH) against the
+# app built locally by create_app, and reports latency per route next to the
+# captured latency, or next to an earlier replay saved with --save
+#
+#   DBUSER=... DBPASS=... SECRET=... python bench/replay.py capture.ndjson \
+#       [--speed 1] [--concurrency 8] [--db URI] [--save out.json] [--baseline before.json]
+#
+# --speed 2 plays twice as fast as recorded, 0 sends each request as soon as
+# a thread is free. point the app at a copy of the database the capture was
+# taken on (--db, or the usual DBUSER/DBPASS/SHARD_URIS), otherwise ids in
+# the paths won't exist. requests are sent in capture order; writes change
+# the copy, restore it before replaying again to get the same run.
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("JOBS_ENABLED", "0")
+# don't capture the replay
+os.environ.pop("RECORD_PATH", None)
+
+
+def load(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r["t"])
+
+
+def replay(app, token_for, records, speed, concurrency):
+    # [(record, status, ms, lag ms)] in capture order
+    local = threading.local()
+    results = [None] * len(records)
+
+    def issue(i, rec, due):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        lag = max(0.0, time.monotonic() - due)
+        headers = {}
+        if rec.get("u") is not None:
+            headers["Authorization"] = token_for(rec["u"])
+        start = time.perf_counter()
+        try:
+            resp = client.open(rec["p"], method=rec["m"], query_string=rec.get("q", ""),
+                               json=rec.get("b"), headers=headers)
+            resp.get_data()
+            resp.close()
+            status = resp.status_code
+        except Exception:
+            # counted as a status mismatch
+            status = None
+        ms = (time.perf_counter() - start) * 1000
+        results[i] = (rec, status, ms, lag * 1000)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        first = records[0]["t"] if records else 0
+        start = time.monotonic()
+        for i, rec in enumerate(records):
+            due = start + (rec["t"] - first) / speed if speed else time.monotonic()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(issue, i, rec, due)
+    return results
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(results):
+    by_route = defaultdict(list)
+    for rec, status, ms, lag in results:
+        by_route[f"{rec['m']} {rec['r']}"].append((rec, status, ms, lag))
+    report = {}
+    for route, rows in by_route.items():
+        report[route] = {
+            "n": len(rows),
+            "captured_p50": statistics.median(r[0]["d"] for r in rows),
+            "captured_p95": percentile([r[0]["d"] for r in rows], 0.95),
+            "p50": statistics.median(r[2] for r in rows),
+            "p95": percentile([r[2] for r in rows], 0.95),
+            "lag_p95": percentile([r[3] for r in rows], 0.95),
+            # a different status than in production, usually missing data
+            "mismatched": sum(1 for r in rows if r[1] != r[0]["s"]),
+        }
+    return report
+
+
+def diff(new, old):
+    return f"{(new - old) * 100 / old:+.0f}%" if old else "-"
+
+
+def print_report(report, baseline):
+    against = "baseline" if baseline else "captured"
+    print(f"{'route':40} {'n':>6} {against + ' p50':>13} {'p95':>8} "
+          f"{'replay p50':>11} {'p95':>8} {'p50 diff':>9} {'status':>7}")
+    for route, r in sorted(report.items(), key=lambda kv: -kv[1]["n"]):
+        if baseline:
+            b = baseline.get(route)
+            if b is None:
+                continue
+            old50, old95 = b["p50"], b["p95"]
+        else:
+            old50, old95 = r["captured_p50"], r["captured_p95"]
+        print(f"{route[:40]:40} {r['n']:6} {old50:10.2f} ms {old95:8.2f} "
+              f"{r['p50']:8.2f} ms {r['p95']:8.2f} {diff(r['p50'], old50):>9} "
+              f"{r['mismatched']:7}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--db", help="SQLALCHEMY_DATABASE_URI of the copy to replay against")
+    parser.add_argument("--save", help="write the per route report here as json")
+    parser.add_argument("--baseline", help="compare with a report saved by --save")
+    args = parser.parse_args()
+
+    import app as mosaic
+
+    if args.db:
+        mosaic.app.config["SQLALCHEMY_DATABASE_URI"] = args.db
+    app = mosaic.create_app(start_jobs=False)
+    tokens = {}
+
+    def token_for(user_id):
+        if user_id not in tokens:
+            tokens[user_id] = mosaic.encode({"id": user_id}, mosaic.secret, algorithm="HS256")
+        return tokens[user_id]
+
+    records = load(args.capture)
+    start = time.monotonic()
+    results = replay(app, token_for, records, args.speed, args.concurrency)
+    took = time.monotonic() - start
+    span = records[-1]["t"] - records[0]["t"] if records else 0
+    print(f"{len(records)} requests in {took:.1f}s (captured over {span:.1f}s), "
+          f"speed {args.speed or 'max'}, {args.concurrency} threads")
+    report = summarize(results)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
@@ -0,0 +1,80 @@
+# production entry point, run from the repository root:
+#
+#   gunicorn -c gunicorn.conf.py
+#
+# the app is imported once in the master (preload_app) and the workers are
+# forked from it. gc.freeze() before the fork moves everything loaded so far
+# out of the collector's reach, so collections in the workers don't write to
+# those pages and they stay shared copy-on-write.
+#
+# the default gevent worker serves each connection as a greenlet, so idle
+# /p/<id>/events streams don't hold a thread each. WORKER_CLASS=gthread runs
+# THREADS threads per worker instead.
+
+import gc
+import multiprocessing
+import os
+
+worker_class = os.environ.get("WORKER_CLASS", "gevent")
+if worker_class == "gevent":
+    # before the app is preloaded, so everything it imports (sockets, locks,
+    # threads, pymysql) is patched in the master the workers fork from
+    from gevent import monkey
+    monkey.patch_all()
+
+pythonpath = "app"
+wsgi_app = "app:create_app(start_jobs=False)"
+bind = os.environ.get("BIND", "0.0.0.0:1337")
+workers = int(os.environ.get("WORKERS", multiprocessing.cpu_count() * 2 + 1))
+# only used by WORKER_CLASS=gthread
+threads = int(os.environ.get("THREADS", 4))
+# open connections per gevent worker, event streams included
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 2000))
+preload_app = True
+graceful_timeout = 30
+
+
+def when_ready(server):
+    # the warm start entries are loaded before the freeze, the workers
+    # share them. see app/warmup.py
+    from app import warmup
+    warmup.load()
+    server.log.info("warm start: %s", warmup.to_dict())
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    # workers respawned later fork from a master that may have allocated
+    # since when_ready
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app, cache, database, runner
+    # never share pooled connections with the master or other workers, on
+    # the main database or any shard
+    with app.app_context():
+        for engine in database.engines.values():
+            engine.dispose(close=False)
+    # listen for invalidations before the first request, a worker that
+    # hasn't published yet would miss them otherwise
+    cache.bus.start()
+    if app.config["JOBS_ENABLED"]:
+        runner.start()
+
+
+def post_worker_init(worker):
+    # after the worker has reset its signal handlers. `kill -USR2 <worker
+    # pid>` profiles that worker for 30s, see app/profiler.py
+    from app import profiler
+    profiler.install_signal()
+
+
+def worker_exit(server, worker):
+    # history views still buffered in this worker, and its hottest cache
+    # entries for the next start
+    from app import app, views, warmup
+    with app.app_context():
+        views.flush()
+    warmup.save()
@@ -0,0 +1,10 @@
+-- per-user post/comment karma and counts (user-036)
+-- create_all() does not add columns to existing tables, run this once on
+-- existing databases, then backfill with cron.reconcile_user_stats() (or
+-- POST /admin/jobs/reconcile_user_stats/run)
+
+ALTER TABLE users
+    ADD COLUMN post_karma INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN comment_karma INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0;
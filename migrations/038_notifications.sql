@@ -0,0 +1,6 @@
+-- reply notifications (user-038)
+-- run once on existing databases, the notifications table itself is created
+-- by create_all()
+
+ALTER TABLE users
+    ADD COLUMN unread_notifs INTEGER NOT NULL DEFAULT 0;
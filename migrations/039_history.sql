@@ -0,0 +1,14 @@
+-- browsing history ring (user-039)
+-- run once on existing databases, the history, saved_posts and
+-- saved_comments tables themselves are created by create_all()
+
+ALTER TABLE users
+    ADD COLUMN history_seq INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN history_cleared_at DATETIME(6) NULL;
+
+-- history_cleared_at and history.viewed_at keep microseconds, a view in the
+-- same second as a clear must still compare as before or after it. on a
+-- database where this migration already ran with plain DATETIME:
+--
+--   ALTER TABLE users MODIFY history_cleared_at DATETIME(6) NULL;
+--   ALTER TABLE history MODIFY viewed_at DATETIME(6) NOT NULL;
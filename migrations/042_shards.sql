@@ -0,0 +1,47 @@
+-- community sharding (user-042)
+-- run once on the main database. existing communities stay on shard 0.
+
+ALTER TABLE communities
+    ADD COLUMN shard INTEGER NOT NULL DEFAULT 0;
+
+-- ids on shard k start at k << 40, past the range of INT
+SET FOREIGN_KEY_CHECKS = 0;
+ALTER TABLE posts MODIFY id BIGINT NOT NULL AUTO_INCREMENT;
+ALTER TABLE comments
+    MODIFY id BIGINT NOT NULL AUTO_INCREMENT,
+    MODIFY post_id BIGINT NOT NULL,
+    MODIFY parent_comment BIGINT NULL;
+ALTER TABLE votes
+    MODIFY id BIGINT NOT NULL AUTO_INCREMENT,
+    MODIFY post_id BIGINT NOT NULL;
+ALTER TABLE comment_votes
+    MODIFY id BIGINT NOT NULL AUTO_INCREMENT,
+    MODIFY comment_id BIGINT NOT NULL;
+ALTER TABLE notifications
+    MODIFY post_id BIGINT NOT NULL,
+    MODIFY comment_id BIGINT NOT NULL;
+ALTER TABLE history MODIFY post_id BIGINT NOT NULL;
+ALTER TABLE saved_posts MODIFY post_id BIGINT NOT NULL;
+ALTER TABLE saved_comments MODIFY comment_id BIGINT NOT NULL;
+SET FOREIGN_KEY_CHECKS = 1;
+
+-- tables in the main database can't keep foreign keys into posts and
+-- comments that live on another shard. look up the constraint names with
+-- SHOW CREATE TABLE and drop the ones pointing at posts or comments:
+--
+--   ALTER TABLE notifications DROP FOREIGN KEY <name>;
+--   ALTER TABLE history DROP FOREIGN KEY <name>;
+--   ALTER TABLE saved_posts DROP FOREIGN KEY <name>;
+--   ALTER TABLE saved_comments DROP FOREIGN KEY <name>;
+
+-- on each new shard k (1, 2, ...), create posts, comments, votes and
+-- comment_votes with the same columns as the main database but without
+-- foreign keys to users or communities, then start their ids at k << 40:
+--
+--   ALTER TABLE posts AUTO_INCREMENT = <(k << 40) + 1>;
+--   ALTER TABLE comments AUTO_INCREMENT = <(k << 40) + 1>;
+--   ALTER TABLE votes AUTO_INCREMENT = <(k << 40) + 1>;
+--   ALTER TABLE comment_votes AUTO_INCREMENT = <(k << 40) + 1>;
+--
+-- shards.create_all(), called by `python app/app.py`, does both for a
+-- development setup.
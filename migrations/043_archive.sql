@@ -0,0 +1,20 @@
+-- post archive (user-043)
+-- the archived_posts and archived_comments tables are created by
+-- create_all(), on shard databases by shards.create_all() or by hand like
+-- the other sharded tables
+
+-- archiving deletes the post and comment rows, which must not cascade to
+-- the history and saved items pointing at them. if not already done for
+-- 042, look up the constraint names with SHOW CREATE TABLE and drop the
+-- foreign keys into posts and comments:
+--
+--   ALTER TABLE history DROP FOREIGN KEY <name>;
+--   ALTER TABLE saved_posts DROP FOREIGN KEY <name>;
+--   ALTER TABLE saved_comments DROP FOREIGN KEY <name>;
+
+-- comment votes keep no time, archive.candidates reads the post's
+-- last_activity instead. run on the main database and on every shard
+-- database
+
+ALTER TABLE posts
+    ADD COLUMN last_activity DATETIME NULL;
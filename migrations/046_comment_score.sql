@@ -0,0 +1,21 @@
+-- stored "best" score for comment sorting (user-046)
+-- run on the main database and on every shard database. the backfill is
+-- the wilson lower bound from ranking.wilson at 80% confidence, the
+-- reconcile_comment_votes job also fixes up any row it gets wrong
+
+ALTER TABLE comments
+    ADD COLUMN score DOUBLE NOT NULL DEFAULT 0;
+
+UPDATE comments
+SET score = (
+    upvotes / (upvotes + downvotes)
+    + 1.642374415151 / (2 * (upvotes + downvotes))
+    - 1.281551565545 * SQRT(
+        (upvotes / (upvotes + downvotes) * (1 - upvotes / (upvotes + downvotes))
+         + 1.642374415151 / (4 * (upvotes + downvotes)))
+        / (upvotes + downvotes))
+) / (1 + 1.642374415151 / (upvotes + downvotes))
+WHERE upvotes + downvotes > 0;
+
+CREATE INDEX ix_comments_post_id_parent_comment_score
+    ON comments (post_id, parent_comment, score);
@@ -0,0 +1,194 @@
+# compact vote tables (user-047), mysql only
+#
+# rebuilds votes and comment_votes with (target, user) as the primary key
+# and a (user, target, direction) index, without stopping the site.
+#
+# the new code addresses a vote by (target, user). on the old layout a
+# duplicate vote would match two rows there, and changing it fails with
+# StaleDataError. so first, with the old code still running:
+#
+#   python migrations/047_compact_votes.py prepare [batch] [pause]
+#
+# deletes duplicate votes by the same user, keeping the newest one, and adds
+# a unique (target, user) key to the old tables so none come back. the old
+# code's racing duplicate inserts now fail instead, and if one lands before
+# the key is in place, adding the key fails: run prepare again. then deploy
+# the code, it works on the old layout from here on. then, on the main
+# database and every SHARD_URIS shard:
+#
+#   1. create votes_new / comment_votes_new, plus triggers that mirror every
+#      insert, update and delete on the old tables into them
+#   2. copy the old rows over `batch` ids at a time, pausing `pause` seconds
+#      between batches so live traffic and replicas keep up. rows written
+#      meanwhile are already there through the triggers and are kept
+#   3. swap the tables with one RENAME TABLE and drop the triggers
+#
+# the old tables are left as votes_old / comment_votes_old, drop them once
+# you're happy. run reconcile_votes after prepare and again at the end
+# (POST /admin/jobs/reconcile_votes/run), the counters still include the
+# dropped duplicates. both steps are safe to run again after a failure, they
+# pick up from the tables already there.
+#
+#   DBUSER=... DBPASS=... SECRET=... [SHARD_URIS=...] \
+#       python migrations/047_compact_votes.py [prepare] [batch] [pause]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+os.environ.setdefault("JOBS_ENABLED", "0")
+
+from sqlalchemy import create_engine, inspect, text
+
+import app as mosaic
+
+TABLES = [
+    # table, target column, target table, direction column, other columns
+    ("votes", "post_id", "posts", "upvote", ["time"]),
+    ("comment_votes", "comment_id", "comments", "is_upvote", []),
+]
+
+COLUMN_TYPES = {
+    "time": "DATETIME NULL DEFAULT CURRENT_TIMESTAMP",
+}
+
+
+def dedupe(engine, table, target, batch, pause):
+    # keep the newest row of each (target, user), `batch` ids at a time
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+    if lo is None:
+        return
+    if engine.dialect.name == "mysql":
+        delete = (f"DELETE v FROM {table} v JOIN {table} w "
+                  f"ON w.{target} = v.{target} AND w.user_id = v.user_id AND w.id > v.id "
+                  f"WHERE v.id >= :first AND v.id < :last")
+    else:
+        # mysql can't read the table it deletes from in a subquery, the tests'
+        # sqlite can't delete through a join
+        delete = (f"DELETE FROM {table} WHERE id >= :first AND id < :last AND EXISTS ("
+                  f"SELECT 1 FROM {table} w WHERE w.{target} = {table}.{target} "
+                  f"AND w.user_id = {table}.user_id AND w.id > {table}.id)")
+    deleted = 0
+    for first in range(lo, hi + 1, batch):
+        with engine.begin() as conn:
+            deleted += conn.execute(
+                text(delete), {"first": first, "last": first + batch}).rowcount
+        time.sleep(pause)
+    print(f"  {table}: {deleted} duplicates deleted", flush=True)
+
+
+def prepare(uri, batch, pause):
+    engine = create_engine(uri)
+    tables = set(inspect(engine).get_table_names())
+    for table, target, parent, direction, extra in TABLES:
+        if f"{table}_old" in tables and f"{table}_new" not in tables:
+            print(f"  {table}: already compact")
+            continue
+        key = f"ux_{table}_{target}_user_id"
+        if key in set(i["name"] for i in inspect(engine).get_indexes(table)):
+            print(f"  {table}: already unique")
+            continue
+        dedupe(engine, table, target, batch, pause)
+        with engine.begin() as conn:
+            # online, writes go on while the index builds
+            conn.execute(text(
+                f"ALTER TABLE {table} ADD UNIQUE KEY {key} ({target}, user_id), "
+                f"ALGORITHM=INPLACE, LOCK=NONE"))
+    engine.dispose()
+
+
+def create(conn, table, target, parent, direction, extra, has_users):
+    new = f"{table}_new"
+    columns = [target, "user_id", direction] + extra
+    fks = [f"FOREIGN KEY ({target}) REFERENCES {parent} (id) ON DELETE CASCADE"]
+    if has_users:
+        # shards don't hold the users table
+        fks.append("FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE")
+    conn.execute(text(f"""
+        CREATE TABLE IF NOT EXISTS {new} (
+            {target} BIGINT NOT NULL,
+            user_id INTEGER NOT NULL,
+            {direction} BOOL NOT NULL,
+            {"".join(f"{c} {COLUMN_TYPES[c]}, " for c in extra)}
+            PRIMARY KEY ({target}, user_id),
+            KEY ix_{table}_user_id_{target} (user_id, {target}, {direction}),
+            {", ".join(fks)}
+        )"""))
+    names = ", ".join(columns)
+    values = ", ".join(f"NEW.{c}" for c in columns)
+    triggers = {
+        "ins": f"AFTER INSERT ON {table} FOR EACH ROW "
+               f"REPLACE INTO {new} ({names}) VALUES ({values})",
+        "upd": f"AFTER UPDATE ON {table} FOR EACH ROW "
+               f"REPLACE INTO {new} ({names}) VALUES ({values})",
+        "del": f"AFTER DELETE ON {table} FOR EACH ROW "
+               f"DELETE FROM {new} WHERE {target} = OLD.{target} AND user_id = OLD.user_id",
+    }
+    existing = set(r[0] for r in conn.execute(text(
+        "SELECT trigger_name FROM information_schema.triggers "
+        "WHERE trigger_schema = DATABASE()")))
+    for suffix, body in triggers.items():
+        name = f"{table}_compact_{suffix}"
+        if name not in existing:
+            conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+
+
+def copy(engine, table, target, direction, extra, batch, pause):
+    new = f"{table}_new"
+    names = ", ".join([target, "user_id", direction] + extra)
+    with engine.connect() as conn:
+        lo, hi = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {table}")).one()
+    if lo is None:
+        return
+    start = time.monotonic()
+    # rows past hi were inserted after the triggers exist
+    for first in range(lo, hi + 1, batch):
+        with engine.begin() as conn:
+            conn.execute(text(
+                f"INSERT IGNORE INTO {new} ({names}) SELECT {names} FROM {table} "
+                f"WHERE id >= :first AND id < :last AND {direction} IS NOT NULL"),
+                {"first": first, "last": first + batch})
+        done = min(first + batch - 1, hi) - lo + 1
+        print(f"  {table}: {done}/{hi - lo + 1} ids, {time.monotonic() - start:.0f}s", flush=True)
+        time.sleep(pause)
+
+
+def swap(conn, table):
+    conn.execute(text(f"RENAME TABLE {table} TO {table}_old, {table}_new TO {table}"))
+    for suffix in ("ins", "upd", "del"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_compact_{suffix}"))
+
+
+def migrate(uri, batch, pause):
+    engine = create_engine(uri)
+    tables = set(inspect(engine).get_table_names())
+    for table, target, parent, direction, extra in TABLES:
+        if f"{table}_old" in tables and f"{table}_new" not in tables:
+            print(f"  {table}: already compact")
+            continue
+        with engine.begin() as conn:
+            create(conn, table, target, parent, direction, extra, "users" in tables)
+        copy(engine, table, target, direction, extra, batch, pause)
+        with engine.begin() as conn:
+            old, new = conn.execute(text(
+                f"SELECT (SELECT COUNT(*) FROM {table}), (SELECT COUNT(*) FROM {table}_new)")).one()
+            print(f"  {table}: {old} rows, {new} after merging duplicates")
+            swap(conn, table)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    step = prepare if args[:1] == ["prepare"] else migrate
+    if step is prepare:
+        args = args[1:]
+    batch = int(args[0]) if len(args) > 0 else 5000
+    pause = float(args[1]) if len(args) > 1 else 0.05
+    config = mosaic.app.config
+    uris = [config["SQLALCHEMY_DATABASE_URI"]] + [
+        config["SQLALCHEMY_BINDS"][name] for name in config["SHARDS"][1:]]
+    for i, uri in enumerate(uris):
+        print(f"shard {i}")
+        step(uri, batch, pause)
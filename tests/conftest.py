@@ -0,0 +1,88 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app reads its config from the environment when it is imported, so this
+# runs first. two sqlite shards, the main database being shard 0
+TMP = tempfile.mkdtemp(prefix="mosaic-tests-")
+os.environ.update(
+    DBUSER="test", DBPASS="test", SECRET="test", JOBS_ENABLED="0", ADMIN_IDS="1",
+    DATA_DIR=TMP, SHARED_STORE_PATH=os.path.join(TMP, "shared.db"),
+    SHARD_URIS="sqlite:///" + os.path.join(TMP, "shard1.db"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import app as mosaic  # noqa: E402
+
+mosaic.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(TMP, "app.db")
+flask_app = mosaic.create_app()
+with flask_app.app_context():
+    mosaic.database.create_all()
+    mosaic.shards.create_all()
+
+# shard 1 ids start here
+SHARD1 = 1 << mosaic.shards.SHARD_BITS
+
+_names = iter(range(1, 1 << 30))
+
+
+def token(user_id):
+    return mosaic.encode({"id": user_id}, "test", algorithm="HS256")
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client():
+    return flask_app.test_client()
+
+
+@pytest.fixture
+def make_user(client):
+    # a new user, as (id, Authorization header)
+    def make():
+        name = f"user{next(_names)}"
+        r = client.post("/u/create", json={"username": name, "password": "pw"})
+        assert r.status_code == 200, r.get_data(as_text=True)
+        with flask_app.app_context():
+            user_id = mosaic.database.session.query(mosaic.db.User.id).filter(
+                mosaic.db.User.username == name).scalar()
+        return user_id, {"Authorization": token(user_id)}
+    return make
+
+
+@pytest.fixture
+def make_community(client, make_user):
+    # a new community on `shard`, created by a new user
+    def make(shard=0):
+        _, auth = make_user()
+        while True:
+            name = f"c{next(_names)}"
+            r = client.post("/c/create", headers=auth, json={"name": name, "description": "d"})
+            assert r.status_code == 200, r.get_data(as_text=True)
+            with flask_app.app_context():
+                community = mosaic.database.session.query(mosaic.db.Community).filter(
+                    mosaic.db.Community.name == name).one()
+                if community.shard == shard:
+                    return community.id
+    return make
+
+
+@pytest.fixture
+def make_post(client, make_user, make_community):
+    # a new post in `community_id` (a new one on shard 0 by default), its id
+    def make(community_id=None, auth=None, title="title", content="content"):
+        if community_id is None:
+            community_id = make_community()
+        if auth is None:
+            auth = make_user()[1]
+        client.post("/c/join", headers=auth, json={"id": community_id})
+        r = client.post("/p/create", headers=auth, json={
+            "title": title, "content": content, "community_id": community_id})
+        assert r.status_code == 200, r.get_data(as_text=True)
+        return r.get_json()["id"]
+    return make
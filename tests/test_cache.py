@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from conftest import mosaic
+
+Cache = mosaic.Cache
+SharedStore = mosaic.SharedStore
+
+
+@pytest.fixture
+def pair(tmp_path):
+    # two workers' caches: one shared store, each with its own bus socket
+    store = SharedStore(str(tmp_path / "shared.db"))
+    a, b = Cache(store), Cache(store)
+    a.bus.start()
+    b.bus.start()
+    return a, b
+
+
+def _eventually(check, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_invalidate_reaches_the_other_worker(pair):
+    a, b = pair
+    assert b.get("post:1", lambda: {"title": "old"}) == {"title": "old"}
+    assert a.get("post:1", lambda: {"title": "unused"}) == {"title": "old"}
+    assert b.local.get("post:1") is not None
+    a.invalidate("post:1")
+    assert _eventually(lambda: b.local.get("post:1") is None)
+    assert b.get("post:1", lambda: {"title": "new"}) == {"title": "new"}
+
+
+def test_stale_load_racing_an_invalidate_is_not_cached(pair):
+    a, b = pair
+
+    def stale():
+        # read the row, then the write commits and invalidates in the
+        # other worker before this load is done
+        value = {"title": "old"}
+        a.invalidate("post:2")
+        return value
+
+    assert b.get("post:2", stale) == {"title": "old"}
+    assert b.local.get("post:2") is None
+    assert b.store.get("post:2") is None
+    assert _eventually(lambda: b.bus.received > 0)
+    assert b.get("post:2", lambda: {"title": "new"}) == {"title": "new"}
+    assert a.get("post:2", lambda: {"title": "unused"}) == {"title": "new"}
+
+
+def test_stale_load_in_the_same_worker_is_not_cached(pair):
+    a, _ = pair
+
+    def stale():
+        value = {"title": "old"}
+        a.invalidate("post:3")
+        return value
+
+    assert a.get("post:3", stale) == {"title": "old"}
+    assert a.local.get("post:3") is None
+    assert a.store.get("post:3") is None
+    assert a.get("post:3", lambda: {"title": "new"}) == {"title": "new"}
+
+
+def test_load_after_an_invalidate_is_cached(pair):
+    a, b = pair
+    a.invalidate("post:4")
+    # once b has heard of it, a load starting later is current
+    assert _eventually(lambda: b.bus.received > 0)
+    assert b.get("post:4", lambda: {"title": "fresh"}) == {"title": "fresh"}
+    assert b.local.get("post:4") == {"title": "fresh"}
+    assert a.get("post:4", lambda: {"title": "unused"}) == {"title": "fresh"}
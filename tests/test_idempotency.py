@@ -0,0 +1,103 @@
+import hashlib
+import json
+import threading
+import time
+
+from conftest import mosaic
+
+db = mosaic.db
+database = mosaic.database
+
+
+def _body(community_id, title="title"):
+    return json.dumps({"title": title, "content": "c", "community_id": community_id})
+
+
+def _create(client, auth, community_id, key, title="title"):
+    return client.post("/p/create", data=_body(community_id, title),
+                       content_type="application/json",
+                       headers=dict(auth, **{"Idempotency-Key": key}))
+
+
+def _posts_by(app, user_id):
+    with app.app_context():
+        return sum(mosaic.shards.gather(lambda: database.session.query(db.Post).filter(
+            db.Post.user_id == user_id).count()))
+
+
+def _in_flight(user_id, key, body):
+    # a claim like the one a first request holds while its handler runs
+    store_key = f"{user_id}:POST:/p/create:{key}"
+    fingerprint = hashlib.sha256(body.encode()).hexdigest()
+    assert mosaic.store.claim(store_key, fingerprint, 60) is None
+    return store_key
+
+
+def test_replay_returns_the_stored_response(app, client, make_user, make_community):
+    community_id = make_community()
+    user_id, auth = make_user()
+    client.post("/c/join", headers=auth, json={"id": community_id})
+    first = _create(client, auth, community_id, "replay")
+    again = _create(client, auth, community_id, "replay")
+    assert first.status_code == again.status_code == 200
+    assert again.get_data() == first.get_data()
+    assert again.content_type == first.content_type
+    assert again.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert _posts_by(app, user_id) == 1
+
+
+def test_keys_are_per_user(app, client, make_user, make_community):
+    community_id = make_community()
+    for _ in range(2):
+        user_id, auth = make_user()
+        client.post("/c/join", headers=auth, json={"id": community_id})
+        r = _create(client, auth, community_id, "shared")
+        assert r.status_code == 200
+        assert "Idempotent-Replayed" not in r.headers
+        assert _posts_by(app, user_id) == 1
+
+
+def test_different_body_is_refused(app, client, make_user, make_community):
+    community_id = make_community()
+    user_id, auth = make_user()
+    client.post("/c/join", headers=auth, json={"id": community_id})
+    first = _create(client, auth, community_id, "reused", title="one")
+    other = _create(client, auth, community_id, "reused", title="two")
+    assert first.status_code == 200
+    assert other.status_code == 422
+    assert _posts_by(app, user_id) == 1
+
+
+def test_duplicate_in_flight_gets_409(app, client, make_user, make_community, monkeypatch):
+    monkeypatch.setattr(mosaic.idem, "wait", 0.2)
+    community_id = make_community()
+    user_id, auth = make_user()
+    client.post("/c/join", headers=auth, json={"id": community_id})
+    _in_flight(user_id, "busy", _body(community_id))
+    r = _create(client, auth, community_id, "busy")
+    assert r.status_code == 409
+    assert "Retry-After" in r.headers
+    assert _posts_by(app, user_id) == 0
+
+
+def test_duplicate_in_flight_gets_the_first_response(app, client, make_user, make_community):
+    community_id = make_community()
+    user_id, auth = make_user()
+    client.post("/c/join", headers=auth, json={"id": community_id})
+    store_key = _in_flight(user_id, "slow", _body(community_id))
+
+    def finish():
+        time.sleep(0.3)
+        mosaic.store.finish(store_key, 200, "application/json", b'{"id": 12345}', 60)
+
+    first = threading.Thread(target=finish)
+    first.start()
+    try:
+        r = _create(client, auth, community_id, "slow")
+    finally:
+        first.join()
+    assert r.status_code == 200
+    assert r.get_json() == {"id": 12345}
+    assert r.headers["Idempotent-Replayed"] == "true"
+    assert _posts_by(app, user_id) == 0
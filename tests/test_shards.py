@@ -0,0 +1,111 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from conftest import SHARD1, mosaic
+
+db = mosaic.db
+database = mosaic.database
+shards = mosaic.shards
+stream = mosaic.stream
+
+
+def test_ids_carry_their_shard(client, app, make_community, make_post):
+    zero = make_post(make_community(shard=0))
+    one = make_post(make_community(shard=1))
+    assert zero < SHARD1 <= one
+    with app.app_context():
+        assert shards.of_id(zero) == 0
+        assert shards.of_id(one) == 1
+        # no shard 2, nor ids that aren't ints
+        assert shards.of_id(2 * SHARD1 + 1) == 0
+        assert shards.of_id("x") == 0
+        with shards.using(0):
+            assert database.session.get(db.Post, one) is None
+            assert database.session.get(db.Post, zero) is not None
+        with shards.using(1):
+            assert database.session.get(db.Post, zero) is None
+            assert database.session.get(db.Post, one) is not None
+    for post_id in (zero, one):
+        r = client.get(f"/p/{post_id}")
+        assert r.status_code == 200
+        assert r.get_json()["id"] == post_id
+
+
+def test_comment_goes_to_its_posts_shard(client, make_user, make_community, make_post):
+    post_id = make_post(make_community(shard=1))
+    _, auth = make_user()
+    r = client.post("/cm/create", headers=auth, json={"content": "hi", "post": post_id})
+    assert r.status_code == 200
+    comments = client.get(f"/p/{post_id}/comments").get_json()
+    assert [c["content"] for c in comments] == ["hi"]
+    assert comments[0]["id"] >= SHARD1
+
+
+def test_top_merges_shards_in_order(app, make_community, make_post):
+    ids = [make_post(make_community(shard=i % 2)) for i in range(8)]
+    votes = dict(zip(ids, [5, 40, 12, 3, 33, 7, 21, 18]))
+    with app.app_context():
+        for post_id, upvotes in votes.items():
+            with shards.using(shards.of_id(post_id)):
+                database.session.query(db.Post).filter(db.Post.id == post_id).update(
+                    {db.Post.upvotes: upvotes})
+                database.session.commit()
+        expected = sorted(ids, key=votes.get, reverse=True)
+
+        def query():
+            return database.session.query(db.Post).filter(
+                db.Post.id.in_(ids)).order_by(db.Post.upvotes.desc())
+
+        def top(limit, offset=0):
+            return [p.id for p in shards.top(query, lambda p: p.upvotes, limit, offset)]
+
+        assert top(8) == expected
+        assert top(3) == expected[:3]
+        assert top(3, offset=2) == expected[2:5]
+        assert top(5, offset=6) == expected[6:]
+        assert [p.id for p in shards.top(query, lambda p: p.upvotes, 8, shards=[1])] == \
+            [i for i in expected if i >= SHARD1]
+
+
+@pytest.fixture
+def only_on_shard_zero(app):
+    # a table the main database has and shard 1 doesn't, so the same query
+    # works on one shard and fails on the other
+    with app.app_context():
+        engine = database.engines[None]
+        with engine.begin() as conn:
+            conn.execute(text("CREATE TABLE scatter_probe (id INTEGER)"))
+    yield
+    with app.app_context():
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE scatter_probe"))
+
+
+def _probed():
+    return shards.Scatter(database.session.query(db.Post).filter(
+        text("posts.id NOT IN (SELECT id FROM scatter_probe)")))
+
+
+def test_scatter_raises_a_failing_shard(app, make_community, make_post, only_on_shard_zero):
+    make_post(make_community(shard=0))
+    with app.app_context():
+        rows = stream._rows(_probed(), lambda p: p.id, False)
+        # shard 0's rows come first, then shard 1's error instead of an end
+        assert next(rows) < SHARD1
+        with pytest.raises(OperationalError):
+            list(rows)
+
+
+def test_prefetched_scatter_raises_a_failing_shard(app, make_community, make_post,
+                                                    only_on_shard_zero):
+    make_post(make_community(shard=0))
+    with app.app_context():
+        items = mosaic.pool.prefetch(lambda: stream._rows(_probed(), lambda p: p.id, False))
+        try:
+            with pytest.raises(OperationalError):
+                list(items)
+        finally:
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
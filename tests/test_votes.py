@@ -0,0 +1,164 @@
+import importlib.util
+import os
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from conftest import mosaic
+
+db = mosaic.db
+database = mosaic.database
+shards = mosaic.shards
+
+
+def _state(app, post_id, user_id):
+    # (vote rows by user_id on the post, upvotes, downvotes)
+    with app.app_context(), shards.using(shards.of_id(post_id)):
+        rows = [v.upvote for v in database.session.query(db.Vote).filter(
+            db.Vote.post_id == post_id, db.Vote.user_id == user_id)]
+        post = database.session.get(db.Post, post_id)
+        return rows, post.upvotes, post.downvotes
+
+
+def _karma(app, user_id):
+    with app.app_context():
+        return database.session.get(db.User, user_id).post_karma
+
+
+def _shard_engine(app, row_id):
+    with app.app_context():
+        return database.engines[app.config["SHARDS"][shards.of_id(row_id)]]
+
+
+def test_repeated_votes_keep_one_row(app, client, make_user, make_post):
+    post_id = make_post()
+    user_id, auth = make_user()
+    steps = [
+        ("upvote", [True], 1, 0),
+        ("upvote", [], 0, 0),
+        ("downvote", [False], 0, 1),
+        ("upvote", [True], 1, 0),
+        ("downvote", [False], 0, 1),
+        ("downvote", [], 0, 0),
+        ("upvote", [True], 1, 0),
+    ]
+    for action, rows, up, down in steps:
+        r = client.post(f"/p/{post_id}/{action}", headers=auth)
+        assert r.status_code == 200
+        assert _state(app, post_id, user_id) == (rows, up, down)
+
+
+def test_concurrent_votes_keep_counters_right(app, client, make_user, make_community,
+                                               make_post):
+    # on shard 1, away from the users table every vote also updates
+    post_id = make_post(make_community(shard=1))
+    user_id, auth = make_user()
+    statuses = []
+
+    def vote(action):
+        statuses.append(client.post(f"/p/{post_id}/{action}", headers=auth).status_code)
+
+    threads = [threading.Thread(target=vote, args=("upvote" if i % 3 else "downvote",))
+               for i in range(12)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # a lost race is a 409, admission may turn some away before they run
+    assert set(statuses) <= {200, 409, 429, 503}
+    assert 200 in statuses
+    rows, up, down = _state(app, post_id, user_id)
+    assert len(rows) <= 1
+    assert (up, down) == (rows.count(True), rows.count(False))
+
+
+@pytest.fixture
+def racing(app, monkeypatch):
+    # runs `race` on its own connection to the post's shard just before the
+    # vote handler commits, as a second request by the same user would
+    def install(post_id, race):
+        engine = _shard_engine(app, post_id)
+        bump = mosaic.karma.bump
+
+        def racing_bump(*args, **kws):
+            with engine.begin() as conn:
+                race(conn)
+            monkeypatch.setattr(mosaic.karma, "bump", bump)
+            return bump(*args, **kws)
+        monkeypatch.setattr(mosaic.karma, "bump", racing_bump)
+    return install
+
+
+def test_racing_first_vote_gets_409(app, client, make_user, make_community, make_post,
+                                    racing):
+    post_id = make_post(make_community(shard=1))
+    user_id, auth = make_user()
+    with app.app_context(), shards.using(1):
+        author = database.session.get(db.Post, post_id).user_id
+    racing(post_id, lambda conn: conn.execute(text(
+        "INSERT INTO votes (post_id, user_id, upvote) VALUES (:p, :u, 1)"),
+        {"p": post_id, "u": user_id}))
+    r = client.post(f"/p/{post_id}/upvote", headers=auth)
+    assert r.status_code == 409
+    assert "Retry-After" in r.headers
+    # the other request's row, and none of this one's counter or karma
+    assert _state(app, post_id, user_id) == ([True], 0, 0)
+    assert _karma(app, author) == 0
+
+
+def test_vote_changed_meanwhile_gets_409(app, client, make_user, make_community, make_post,
+                                         racing):
+    post_id = make_post(make_community(shard=1))
+    user_id, auth = make_user()
+    assert client.post(f"/p/{post_id}/downvote", headers=auth).status_code == 200
+    racing(post_id, lambda conn: conn.execute(text(
+        "DELETE FROM votes WHERE post_id = :p AND user_id = :u"),
+        {"p": post_id, "u": user_id}))
+    r = client.post(f"/p/{post_id}/upvote", headers=auth)
+    assert r.status_code == 409
+    assert _state(app, post_id, user_id) == ([], 0, 1)
+
+
+def test_racing_first_comment_vote_gets_409(app, client, make_user, make_community,
+                                            make_post, racing):
+    post_id = make_post(make_community(shard=1))
+    user_id, auth = make_user()
+    assert client.post("/cm/create", headers=auth,
+                       json={"content": "c", "post": post_id}).status_code == 200
+    with app.app_context(), shards.using(1):
+        comment_id = database.session.query(db.Comment.id).filter(
+            db.Comment.post_id == post_id).scalar()
+    racing(post_id, lambda conn: conn.execute(text(
+        "INSERT INTO comment_votes (comment_id, user_id, is_upvote) VALUES (:c, :u, 0)"),
+        {"c": comment_id, "u": user_id}))
+    r = client.post(f"/cm/{comment_id}/upvote", headers=auth)
+    assert r.status_code == 409
+    with app.app_context(), shards.using(1):
+        comment = database.session.get(db.Comment, comment_id)
+        assert (comment.upvotes or 0, comment.downvotes or 0) == (0, 0)
+
+
+def _migration():
+    path = os.path.join(os.path.dirname(__file__), "..", "migrations", "047_compact_votes.py")
+    spec = importlib.util.spec_from_file_location("compact_votes", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_dedupe_keeps_the_newest_vote(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        # the layout before 047, with a surrogate id
+        conn.execute(text("CREATE TABLE votes (id INTEGER PRIMARY KEY, "
+                          "post_id INTEGER, user_id INTEGER, upvote BOOLEAN)"))
+        conn.execute(text("INSERT INTO votes (id, post_id, user_id, upvote) VALUES "
+                          "(1, 10, 1, 1), (2, 10, 2, 1), (3, 10, 1, 0), (4, 11, 1, 1), "
+                          "(5, 10, 1, 1), (6, 11, 2, 0), (7, 10, 2, 0), (8, 12, 3, 1)"))
+    _migration().dedupe(engine, "votes", "post_id", batch=3, pause=0)
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT id, post_id, user_id, upvote FROM votes ORDER BY id")).all()
+    assert [tuple(r) for r in rows] == [
+        (4, 11, 1, 1), (5, 10, 1, 1), (6, 11, 2, 0), (7, 10, 2, 0), (8, 12, 3, 1)]